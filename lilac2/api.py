@@ -4,14 +4,20 @@ import re
 import os
 import subprocess
 import traceback
-from typing import Tuple, Optional, Iterator, Dict, List, Union
+import threading
+import contextlib
+from typing import Tuple, Optional, Iterator, Dict, List, Union, Iterable
 import fileinput
-import tempfile
+import hashlib
+from pathlib import Path
 
-from myutils import at_dir
+from myutils import file_lock
 
 from .cmd import run_cmd, git_pull, git_push
 from . import const
+from . import pkgbuild
+from . import srccache
+from . import vcs
 from .const import _G
 
 git_push
@@ -67,23 +73,63 @@ def edit_file(filename: str) -> Iterator[str]:
     for line in f:
       yield line.rstrip('\n')
 
+_OBTAIN_SCRIPT = '''\
+source PKGBUILD >&2 || exit
+for _lilac_name; do
+  unset -n _lilac_var
+  declare -n _lilac_var=$_lilac_name
+  printf '%s\\0%d\\0' "$_lilac_name" "${#_lilac_var[@]}"
+  if (( ${#_lilac_var[@]} )); then
+    printf '%s\\0' "${_lilac_var[@]}"
+  fi
+done
+'''
+_obtained: Dict[Tuple[str, bytes], Dict[str, Optional[List[str]]]] = {}
+
+def obtain_variables(
+  names: Iterable[str],
+) -> Dict[str, Optional[List[str]]]:
+  '''
+  Obtain variables and arrays from PKGBUILD in one go.
+
+  PKGBUILD is sourced by one bash process which writes the values out
+  NUL-delimited. A scalar is returned as an array of one item; an unset
+  variable or an empty array as None. Results are remembered until
+  PKGBUILD changes.
+  '''
+  with open('PKGBUILD', 'rb') as f:
+    key = os.getcwd(), hashlib.sha1(f.read()).digest()
+  known = _obtained.get(key)
+  if known is None:
+    if len(_obtained) > 32:
+      _obtained.clear()
+    known = _obtained[key] = {}
+
+  names = list(names)
+  missing = [x for x in names if x not in known]
+  if missing:
+    p = subprocess.run(
+      ['bash', '-c', _OBTAIN_SCRIPT, 'obtain_variables'] + missing,
+      stdout = subprocess.PIPE, stderr = subprocess.PIPE, check = True,
+    )
+    fields = iter(p.stdout.decode().split('\0'))
+    for name in fields:
+      if not name:
+        break
+      count = int(next(fields))
+      known[name] = [next(fields) for _ in range(count)] or None
+
+  return {x: known[x] for x in names}
+
 def obtain_array(name: str) -> Optional[List[str]]:
   '''
   Obtain an array variable from PKGBUILD.
-  Works by calling bash to source PKGBUILD, writing the array to a temporary file, and reading from the file.
+  See obtain_variables for how it works.
   '''
-  with tempfile.NamedTemporaryFile() as output_file:
-    command_write_array_out = """printf "%s\\0" "${{{}[@]}}" > {}""" \
-        .format(name, output_file.name)
-    command_export_array = ['bash', '-c', "source PKGBUILD && {}".format(
-      command_write_array_out)]
-    subprocess.run(command_export_array, stderr=subprocess.PIPE,
-                   check=True)
-    res = output_file.read().decode()
-    if res == '\0':
-      return None
-    variable = res.split('\0')[:-1]
-    return variable
+  variable = obtain_variables([name])[name]
+  if variable == ['']:
+    return None
+  return variable
 
 def obtain_depends() -> Optional[List[str]]:
   return obtain_array('depends')
@@ -106,20 +152,20 @@ def obtain_optdepends(
 def vcs_update() -> None:
   # clean up the old source tree
   shutil.rmtree('src', ignore_errors=True)
+  vcs.use_mirrors(Path('.'), pkgbuild.get_srcinfo())
   run_cmd(['makepkg', '-od'], use_pty=True)
 
 def get_pkgver_and_pkgrel(
 ) -> Tuple[Optional[str], Optional[float]]:
-  pkgrel = None
+  pkgrel: Optional[float] = None
   pkgver = None
-  with open('PKGBUILD') as f:
-    for l in f:
-      if l.startswith('pkgrel='):
-        pkgrel = float(l.rstrip().split('=', 1)[-1].strip('\'"'))
-        if int(pkgrel) == pkgrel:
-            pkgrel = int(pkgrel)
-      elif l.startswith('pkgver='):
-        pkgver = l.rstrip().split('=', 1)[-1]
+  vars = obtain_variables(['pkgver', 'pkgrel'])
+  if vars['pkgrel']:
+    pkgrel = float(vars['pkgrel'][0])
+    if int(pkgrel) == pkgrel:
+        pkgrel = int(pkgrel)
+  if vars['pkgver']:
+    pkgver = vars['pkgver'][0]
 
   return pkgver, pkgrel
 
@@ -142,6 +188,8 @@ def update_pkgver_and_pkgrel(
 
   if updpkgsums:
     run_cmd(["updpkgsums"])
+    # the build and other packages can use what it has downloaded
+    srccache.sync(Path('.'), pkgbuild.get_srcinfo())
 
 def update_pkgrel(rel=None):
   with open('PKGBUILD') as f:
@@ -247,21 +295,43 @@ check() {
     update_pkgrel(pkgrel)
 
 def pypi_post_build():
-  git_add_files('PKGBUILD')
-  git_commit()
+  with git_index_lock():
+    git_add_files('PKGBUILD')
+    git_commit()
+
+_index_lock = threading.local()
+
+@contextlib.contextmanager
+def git_index_lock() -> Iterator[None]:
+  '''lock the git index, which builds running at the same time share
+
+  It may be taken again while held, so that what is staged and its commit
+  can be done under one lock.
+  '''
+  if getattr(_index_lock, 'held', False):
+    yield
+    return
+
+  with file_lock(const.mydir / '.git-index.lock'):
+    _index_lock.held = True
+    try:
+      yield
+    finally:
+      _index_lock.held = False
 
 def git_add_files(files, *, force=False):
   if isinstance(files, str):
     files = [files]
-  try:
-    if force:
-      run_cmd(['git', 'add', '-f', '--'] + files)
-    else:
-      run_cmd(['git', 'add', '--'] + files)
-  except subprocess.CalledProcessError:
-    # on error, there may be a partial add, e.g. some files are ignored
-    run_cmd(['git', 'reset', '--'] + files)
-    raise
+  with git_index_lock():
+    try:
+      if force:
+        run_cmd(['git', 'add', '-f', '--'] + files)
+      else:
+        run_cmd(['git', 'add', '--'] + files)
+    except subprocess.CalledProcessError:
+      # on error, there may be a partial add, e.g. some files are ignored
+      run_cmd(['git', 'reset', '--'] + files)
+      raise
 
 def git_commit(*, check_status=True):
   if check_status:
@@ -271,8 +341,11 @@ def git_commit(*, check_status=True):
     if not ret:
       return
 
-  run_cmd(['git', 'commit', '-m', 'auto update for package %s' % (
-    os.path.split(os.getcwd())[1])])
+  # hold git_index_lock() from staging to here, or others' files may be
+  # committed too
+  with git_index_lock():
+    run_cmd(['git', 'commit', '-m', 'auto update for package %s' % (
+      os.path.split(os.getcwd())[1])])
 
 def git_reset_hard():
   run_cmd(['git', 'reset', '--hard'])
@@ -285,12 +358,11 @@ def _update_aur_repo_real(pkgname: str) -> None:
   aurpath = const.AUR_REPO_DIR / pkgname
   if not os.path.isdir(aurpath):
     logger.info('cloning AUR repo: %s', aurpath)
-    with at_dir(const.AUR_REPO_DIR):
-      run_cmd(['git', 'clone', 'aur@aur.archlinux.org:%s.git' % pkgname])
+    run_cmd(['git', 'clone', 'aur@aur.archlinux.org:%s.git' % pkgname],
+            cwd = const.AUR_REPO_DIR)
   else:
-    with at_dir(aurpath):
-      git_reset_hard()
-      git_pull()
+    run_cmd(['git', 'reset', '--hard'], cwd = aurpath)
+    run_cmd(['git', 'pull', '--no-edit'], cwd = aurpath)
 
   logger.info('copying files to AUR repo: %s', aurpath)
   files = run_cmd(['git', 'ls-files']).splitlines()
@@ -300,19 +372,16 @@ def _update_aur_repo_real(pkgname: str) -> None:
     logger.debug('copying file %s', f)
     shutil.copy(f, aurpath)
 
-  with at_dir(aurpath):
-    with open('.SRCINFO', 'wb') as srcinfo:
-      subprocess.run(
-        ['makepkg', '--printsrcinfo'],
-        stdout = srcinfo,
-        check = True,
-      )
-    run_cmd(['git', 'add', '.'])
-    run_cmd(['bash', '-c', 'git diff-index --quiet HEAD || git commit -m "update by lilac"'])
-    run_cmd(['git', 'push'])
+  srcinfo = pkgbuild.get_srcinfo(aurpath)
+  with open(aurpath / '.SRCINFO', 'w') as srcinfo_file:
+    srcinfo_file.write(''.join(x + '\n' for x in srcinfo))
+  run_cmd(['git', 'add', '.'], cwd = aurpath)
+  run_cmd(['bash', '-c', 'git diff-index --quiet HEAD || git commit -m "update by lilac"'],
+          cwd = aurpath)
+  run_cmd(['git', 'push'], cwd = aurpath)
 
 def update_aur_repo() -> None:
-  pkgbase = _G.mod.pkgbase
+  pkgbase = os.path.basename(os.getcwd())
   try:
     _update_aur_repo_real(pkgbase)
   except subprocess.CalledProcessError as e:
@@ -324,6 +393,7 @@ def update_aur_repo() -> None:
     )
 
 def git_pkgbuild_commit() -> None:
-  git_add_files('PKGBUILD')
-  git_commit()
+  with git_index_lock():
+    git_add_files('PKGBUILD')
+    git_commit()
 
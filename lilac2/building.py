@@ -0,0 +1,270 @@
+import os
+import sys
+import re
+import json
+import heapq
+import logging
+import subprocess
+import tempfile
+import statistics
+from collections import defaultdict
+from pathlib import Path
+from typing import (
+  Dict, Set, Iterable, Optional, Any, BinaryIO, List, Tuple,
+)
+
+from .tools import topdir
+from .api import AurDownloadError
+
+logger = logging.getLogger(__name__)
+
+class BuildHistory:
+  '''Recent durations of successful builds, in seconds.
+
+  ``data`` is kept as-is so that it can live in lilac's store.
+  '''
+
+  def __init__(self, data: Dict[str, List[float]], keep: int = 5) -> None:
+    self.data = data
+    self.keep = keep
+
+  def add(self, pkg: str, duration: float) -> None:
+    ds = self.data.setdefault(pkg, [])
+    ds.append(duration)
+    del ds[:-self.keep]
+
+  def estimate(self, pkg: str) -> Optional[float]:
+    ds = self.data.get(pkg)
+    if not ds:
+      return None
+    return statistics.median(ds)
+
+  def estimates(self, pkgs: Iterable[str]) -> Dict[str, float]:
+    '''estimated durations; unknown packages get the median of known ones'''
+    ret = {}
+    unknown = []
+    for p in pkgs:
+      e = self.estimate(p)
+      if e is None:
+        unknown.append(p)
+      else:
+        ret[p] = e
+
+    if unknown:
+      known: List[float] = [
+        e for e in map(self.estimate, self.data) if e is not None]
+      default = statistics.median(known) if known else 1.0
+      for p in unknown:
+        ret[p] = default
+    return ret
+
+_build_log_re = re.compile(
+  r'^\[[^]]+\] (?P<pkg>\S+) .* successful after (?P<secs>\d+)s$')
+
+def load_history_from_log(file: Path) -> Dict[str, List[float]]:
+  '''recover durations from the plain text build.log'''
+  data: Dict[str, List[float]] = defaultdict(list)
+  try:
+    with open(file, errors='replace') as f:
+      for l in f:
+        m = _build_log_re.match(l.rstrip('\n'))
+        if m:
+          data[m.group('pkg')].append(float(m.group('secs')))
+  except FileNotFoundError:
+    pass
+  return dict(data)
+
+class BuildSorter:
+  '''Hand out packages whose dependencies in this run have finished.
+
+  ``packages`` should be in topological order. Among ready packages the one
+  with the longest remaining critical path (by ``durations``) goes first;
+  without durations it's the one with the longest chain of dependers.
+  '''
+
+  def __init__(
+    self, depmap: Dict[str, Set[str]], packages: Iterable[str],
+    durations: Optional[Dict[str, float]] = None,
+  ) -> None:
+    self._order = {p: i for i, p in enumerate(packages)}
+    self._waiting: Dict[str, Set[str]] = {}
+    self._dependers: Dict[str, Set[str]] = defaultdict(set)
+    for p in self._order:
+      ds = {d for d in depmap.get(p, ()) if d in self._order and d != p}
+      self._waiting[p] = ds
+      for d in ds:
+        self._dependers[d].add(p)
+
+    self.durations = {
+      p: (durations or {}).get(p, 1.0) for p in self._order}
+    self.priority = self._critical_paths()
+
+    self._ready = {p for p, ds in self._waiting.items() if not ds}
+    self._unfinished = set(self._order)
+
+  def _critical_paths(self) -> Dict[str, float]:
+    ret: Dict[str, float] = {}
+    for root in self._order:
+      if root in ret:
+        continue
+      # depth first over dependers, without recursion for long chains;
+      # a package is given its own duration first to guard against cycles
+      ret[root] = self.durations[root]
+      stack = [(root, iter(self._dependers.get(root, ())))]
+      while stack:
+        p, it = stack[-1]
+        for d in it:
+          if d not in ret:
+            ret[d] = self.durations[d]
+            stack.append((d, iter(self._dependers.get(d, ()))))
+            break
+        else:
+          stack.pop()
+          ret[p] = self.durations[p] + max(
+            (ret[d] for d in self._dependers.get(p, ())), default=0)
+    return ret
+
+  def _key(self, p: str) -> Tuple[float, int]:
+    return -self.priority[p], self._order[p]
+
+  def add(
+    self, pkg: str, deps: Iterable[str], duration: float = 1.0,
+  ) -> None:
+    '''add ``pkg`` to a running sorter
+
+    It waits for those of ``deps`` that are in this sorter and not done yet,
+    so they should be added before it.
+    '''
+    self._order[pkg] = len(self._order)
+    ds = {d for d in deps if d in self._unfinished and d != pkg}
+    self._waiting[pkg] = ds
+    for d in ds:
+      self._dependers[d].add(pkg)
+    self.durations[pkg] = duration
+    self._unfinished.add(pkg)
+    self._raise_priorities(pkg)
+    if not ds:
+      self._ready.add(pkg)
+
+  def _raise_priorities(self, pkg: str) -> None:
+    '''update critical paths of what unfinished ``pkg`` waits for'''
+    self.priority[pkg] = self.durations[pkg]
+    # latest first, so that each package is done after all its dependers
+    heap = [(-self._order[pkg], pkg)]
+    queued = {pkg}
+    while heap:
+      _, p = heapq.heappop(heap)
+      for d in self._waiting[p]:
+        if self._order[d] >= self._order[p]:
+          # a cycle
+          continue
+        length = self.durations[d] + self.priority[p]
+        if length > self.priority[d]:
+          self.priority[d] = length
+          if d not in queued:
+            queued.add(d)
+            heapq.heappush(heap, (-self._order[d], d))
+
+  def is_active(self) -> bool:
+    return bool(self._unfinished)
+
+  def pop_ready(self) -> Optional[str]:
+    if not self._ready:
+      return None
+    pkg = min(self._ready, key=self._key)
+    self._ready.remove(pkg)
+    return pkg
+
+  def done(self, pkg: str) -> None:
+    self._unfinished.discard(pkg)
+    for p in self._dependers.get(pkg, ()):
+      waiting = self._waiting[p]
+      waiting.discard(pkg)
+      if not waiting:
+        self._ready.add(p)
+
+def estimate_run_time(
+  depmap: Dict[str, Set[str]], packages: List[str],
+  durations: Dict[str, float], workers: int,
+) -> float:
+  '''simulate a run with ``workers`` builders and return its length'''
+  sorter = BuildSorter(depmap, packages, durations)
+  now = 0.0
+  running: List[Tuple[float, str]] = []
+  while sorter.is_active():
+    while len(running) < workers:
+      pkg = sorter.pop_ready()
+      if pkg is None:
+        break
+      heapq.heappush(running, (now + sorter.durations[pkg], pkg))
+    if not running:
+      break
+    now, pkg = heapq.heappop(running)
+    sorter.done(pkg)
+  return now
+
+def call_worker(
+  pkgdir: Path, input: Dict[str, Any], logfile: BinaryIO,
+  packager: str,
+) -> Dict[str, Any]:
+  '''run lilac2.worker for ``pkgdir`` in a separate process
+
+  Everything the build changes (cwd, environment, module state) stays in
+  that process, so several of them can run at the same time.
+  '''
+  env = os.environ.copy()
+  env['PACKAGER'] = packager
+  env['PYTHONPATH'] = os.pathsep.join(
+    [str(topdir), str(topdir / 'vendor')]
+    + [x for x in [os.environ.get('PYTHONPATH')] if x])
+
+  with tempfile.NamedTemporaryFile(
+    mode='r', prefix='lilac-result-', suffix='.json') as result:
+    input = dict(input, result=result.name)
+    p = subprocess.run(
+      [sys.executable, '-m', 'lilac2.worker', pkgdir.name],
+      input = json.dumps(input).encode(),
+      stdout = logfile, stderr = subprocess.STDOUT,
+      cwd = pkgdir, env = env,
+    )
+    try:
+      r = json.load(result)
+    except ValueError:
+      r = {
+        'status': 'failed',
+        'version': None,
+        'error': {
+          'type': 'WorkerError',
+          'msg': f'worker exited with code {p.returncode}',
+        },
+        'traceback': '',
+      }
+  return r
+
+def serialize_error(e: Exception) -> Dict[str, Any]:
+  d: Dict[str, Any] = {
+    'type': type(e).__name__,
+    'msg': str(e),
+  }
+  if isinstance(e, subprocess.CalledProcessError):
+    if isinstance(e.cmd, (list, tuple)):
+      d['cmd'] = [str(x) for x in e.cmd]
+    else:
+      d['cmd'] = str(e.cmd)
+    d['returncode'] = e.returncode
+    output = e.output
+    if isinstance(output, bytes):
+      output = output.decode('utf-8', errors='replace')
+    d['output'] = output
+  elif isinstance(e, AurDownloadError):
+    d['pkgname'] = e.pkgname
+  return d
+
+def deserialize_error(d: Dict[str, Any]) -> Exception:
+  if d['type'] == 'CalledProcessError':
+    return subprocess.CalledProcessError(
+      d['returncode'], d['cmd'], d['output'])
+  elif d['type'] == 'AurDownloadError':
+    return AurDownloadError(d['pkgname'])
+  else:
+    return Exception(d['msg'])
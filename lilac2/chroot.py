@@ -0,0 +1,198 @@
+'''
+prepared chroots for building packages, shared by the builds of a run
+
+Chroots use the layout of devtools' archbuild: ``<basedir>/<build_prefix>``
+has the ``root`` chroot and working copies next to it. Each root is
+updated at most once per run. Builds then call makechrootpkg directly with
+a working copy of their own, which makechrootpkg makes as a btrfs snapshot
+of the root when it's a subvolume and by rsync otherwise. A working copy is
+made again from the updated root the first time it's used in a run.
+'''
+
+import shlex
+import logging
+import threading
+import contextlib
+from pathlib import Path
+from typing import Dict, Optional, List, Iterator, NamedTuple, Set, Tuple
+
+from .cmd import run_cmd
+from .localrepo import LocalRepo
+
+logger = logging.getLogger(__name__)
+
+CHROOT_DIR = Path('/var/lib/archbuild')
+# what lilac puts into config files of the roots is between these lines
+_CONF_BEGIN = '# lilac settings begin'
+_CONF_END = '# lilac settings end'
+
+def makepkg_conf_script(pkgext: str) -> str:
+  '''shell commands to put package settings into /etc/makepkg.conf
+
+  makechrootpkg doesn't pass PKGEXT into the chroot, so it's set there,
+  along with multithreaded compression.
+  '''
+  lines = [
+    _CONF_BEGIN,
+    f'PKGEXT={shlex.quote(pkgext)}',
+    'COMPRESSZST=(zstd -c -T0 -)',
+    'COMPRESSXZ=(xz -c -z -T0 -)',
+    _CONF_END,
+  ]
+  conf = '/etc/makepkg.conf'
+  return (
+    f"sed -i '/^{_CONF_BEGIN}$/,/^{_CONF_END}$/d' {conf} && "
+    f"printf '%s\\n' {' '.join(shlex.quote(l) for l in lines)} >> {conf}"
+  )
+
+def pacman_conf_with_repo(conf: str, name: str, dir: Path) -> str:
+  '''``conf`` with the repository ``name`` in ``dir`` before other ones
+
+  Packages in it are unsigned, and are preferred to those of the same name
+  in other repositories. An earlier one added here is replaced.
+  '''
+  lines: List[str] = []
+  skip = after = False
+  for l in conf.splitlines():
+    if l == _CONF_BEGIN:
+      skip = True
+    elif l == _CONF_END:
+      skip = False
+      # the empty line put after it goes too
+      after = True
+      continue
+    elif not skip and not (after and not l):
+      lines.append(l)
+    after = False
+
+  repo = [
+    _CONF_BEGIN,
+    f'[{name}]',
+    'SigLevel = Never',
+    f'Server = file://{dir}',
+    _CONF_END,
+  ]
+  for i, l in enumerate(lines):
+    section = l.strip()
+    if section.startswith('[') and section != '[options]':
+      lines[i:i] = repo + ['']
+      break
+  else:
+    lines.extend(repo)
+  return ''.join(l + '\n' for l in lines)
+
+class Chroot(NamedTuple):
+  # the directory with the root chroot and working copies
+  dir: Path
+  # name of the working copy
+  copy: str
+  # whether to make the working copy again from the root
+  clean: bool = False
+  # the database of the local repository in the chroot's pacman.conf
+  localrepo_db: Optional[Path] = None
+
+  def makechrootpkg_cmd(self) -> List[str]:
+    cmd = ['makechrootpkg', '-r', str(self.dir), '-l', self.copy]
+    if self.clean:
+      cmd.append('-c')
+    if self.localrepo_db is not None:
+      # the current database is mounted over the synced one, so packages
+      # built since the root was updated are found without syncing anything
+      db = self.localrepo_db
+      cmd += [
+        '-D', str(db.parent),
+        '-D', f'{db}:/var/lib/pacman/sync/{db.name}',
+      ]
+    return cmd
+
+class ChrootPool:
+  '''Root chroots of build prefixes and working copies leased from them.
+
+  A prefix whose root doesn't exist yet isn't managed for the whole run;
+  its builds go through ``<prefix>-build``, which creates the root.
+  With ``pkgext``, it's set in the roots' makepkg.conf when they're updated.
+  With ``localrepo``, it's added to their pacman.conf.
+  '''
+
+  def __init__(
+    self, basedir: Path = CHROOT_DIR, pkgext: Optional[str] = None,
+    localrepo: Optional[LocalRepo] = None,
+  ) -> None:
+    self.basedir = basedir
+    self.pkgext = pkgext
+    self.localrepo = localrepo
+    self._prepared: Dict[str, Optional[Path]] = {}
+    self._prefix_locks: Dict[str, threading.Lock] = {}
+    self._leased: Dict[str, Set[int]] = {}
+    self._synced: Set[Tuple[str, int]] = set()
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def lease(self, build_prefix: str) -> Iterator[Optional[Chroot]]:
+    '''a working copy for one build, or None if it can't be provided'''
+    if build_prefix == 'makepkg':
+      yield None
+      return
+
+    chrootdir = self.prepare(build_prefix)
+    if chrootdir is None:
+      yield None
+      return
+
+    with self._lock:
+      leased = self._leased.setdefault(build_prefix, set())
+      slot = 0
+      while slot in leased:
+        slot += 1
+      leased.add(slot)
+      clean = (build_prefix, slot) not in self._synced
+      self._synced.add((build_prefix, slot))
+    try:
+      yield Chroot(chrootdir, f'lilac-{slot}', clean,
+                   self.localrepo.sync_db if self.localrepo else None)
+    finally:
+      with self._lock:
+        leased.remove(slot)
+
+  def prepare(self, build_prefix: str) -> Optional[Path]:
+    '''update the root of ``build_prefix`` if not done in this run yet'''
+    with self._lock:
+      lock = self._prefix_locks.setdefault(build_prefix, threading.Lock())
+
+    with lock:
+      if build_prefix in self._prepared:
+        return self._prepared[build_prefix]
+
+      chrootdir: Optional[Path] = self.basedir / build_prefix
+      root = self.basedir / build_prefix / 'root'
+      if not root.is_dir():
+        logger.warning('%s doesn\'t exist; using %s-build',
+                       root, build_prefix)
+        chrootdir = None
+      else:
+        logger.info('updating chroot %s', root)
+        try:
+          nspawn_args = []
+          if self.localrepo is not None:
+            self._add_localrepo(root, self.localrepo)
+            nspawn_args.append(f'--bind-ro={self.localrepo.dir}')
+          run_cmd(['arch-nspawn', str(root), *nspawn_args,
+                   'pacman', '-Syuu', '--noconfirm'])
+          if self.pkgext is not None:
+            run_cmd(['arch-nspawn', str(root), 'sh', '-c',
+                     makepkg_conf_script(self.pkgext)])
+        except Exception:
+          logger.exception('failed to update chroot %s; using %s-build',
+                           root, build_prefix)
+          chrootdir = None
+
+      self._prepared[build_prefix] = chrootdir
+      return chrootdir
+
+  def _add_localrepo(self, root: Path, localrepo: LocalRepo) -> None:
+    with open(root / 'etc' / 'pacman.conf') as f:
+      conf = f.read()
+    new = pacman_conf_with_repo(conf, localrepo.name, localrepo.dir)
+    if new != conf:
+      run_cmd(['arch-nspawn', str(root), 'sh', '-c',
+               'printf %s "$1" > /etc/pacman.conf', 'sh', new])
@@ -1,12 +1,12 @@
 import os
+import errno
 import logging
 import subprocess
-import signal
+import selectors
 import sys
-import re
+from collections import deque
 from subprocess import CalledProcessError
-from typing import Optional
-import types
+from typing import Optional, List, Deque, BinaryIO
 
 from .typing import Cmd
 
@@ -27,8 +27,77 @@ def git_push() -> None:
       else:
         raise
 
+class _LineCleaner:
+  '''remove ^O and squash progress lines, a chunk at a time
+
+  The result is the same as ``re.sub(r'.*\r', '', output)`` after turning
+  \r\n into \n, but the pending line is never longer than what's after
+  its last \r.
+  '''
+
+  def __init__(self) -> None:
+    self._pending = b''
+
+  def feed(self, data: bytes) -> List[bytes]:
+    lines = (self._pending + data.replace(b'\x0f', b'')).split(b'\n')
+    pending = lines.pop()
+    # what's before a \r that isn't the last byte will be erased anyway
+    i = pending.rfind(b'\r', 0, len(pending) - 1)
+    self._pending = pending[i+1:]
+
+    ret = []
+    for l in lines:
+      if l.endswith(b'\r'):
+        l = l[:-1]
+      ret.append(l[l.rfind(b'\r')+1:] + b'\n')
+    return ret
+
+  def close(self) -> List[bytes]:
+    l = self._pending[self._pending.rfind(b'\r')+1:]
+    self._pending = b''
+    return [l] if l else []
+
+class _OutputWindow:
+  '''keep the first and last ``size`` characters of output (all if None)'''
+
+  def __init__(self, size: Optional[int]) -> None:
+    self.size = size
+    self._head: List[str] = []
+    self._head_len = 0
+    self._tail: Deque[str] = deque()
+    self._tail_len = 0
+    self._omitted = 0
+
+  def add(self, s: str) -> None:
+    if self.size is None or self._head_len < self.size:
+      self._head.append(s)
+      self._head_len += len(s)
+      return
+
+    self._tail.append(s)
+    self._tail_len += len(s)
+    while self._tail_len > self.size and len(self._tail) > 1:
+      x = self._tail.popleft()
+      self._tail_len -= len(x)
+      self._omitted += len(x)
+
+  def getvalue(self) -> str:
+    s = ''.join(self._head)
+    if self._omitted:
+      s += f'\n[... {self._omitted} characters omitted ...]\n'
+    return s + ''.join(self._tail)
+
 def run_cmd(cmd: Cmd, *, use_pty: bool = False, silent: bool = False,
-            cwd: Optional[os.PathLike] = None) -> str:
+            cwd: Optional[os.PathLike] = None,
+            logfile: Optional[BinaryIO] = None,
+            output_window: Optional[int] = None) -> str:
+  '''run ``cmd`` and return its output with progress lines squashed
+
+  Output is copied to stderr as-is unless ``silent``, and written cleaned
+  up to ``logfile`` as it comes. With ``output_window``, only about that
+  many characters from the start and the end are kept for the return
+  value and ``CalledProcessError.output``.
+  '''
   logger.debug('running %r, %susing pty,%s showing output', cmd,
                '' if use_pty else 'not ',
                ' not' if silent else '')
@@ -41,12 +110,6 @@ def run_cmd(cmd: Cmd, *, use_pty: bool = False, silent: bool = False,
     stdin = subprocess.DEVNULL
     stdout = subprocess.PIPE
 
-  exited = False
-  def child_exited(signum: int, sigframe: types.FrameType) -> None:
-    nonlocal exited
-    exited = True
-  old_hdl = signal.signal(signal.SIGCHLD, child_exited)
-
   p = subprocess.Popen(
     cmd, stdin = stdin, stdout = stdout, stderr = subprocess.STDOUT,
     cwd = cwd,
@@ -54,40 +117,49 @@ def run_cmd(cmd: Cmd, *, use_pty: bool = False, silent: bool = False,
   if use_pty:
     os.close(stdout)
   else:
+    assert p.stdout is not None
     rfd = p.stdout.fileno()
-  out = []
 
-  while True:
-    try:
-      r = os.read(rfd, 4096)
-      if not r:
-        if exited:
+  cleaner = _LineCleaner()
+  window = _OutputWindow(output_window)
+  def emit(lines: List[bytes]) -> None:
+    for l in lines:
+      if logfile is not None:
+        logfile.write(l)
+      window.add(l.decode('utf-8', errors='replace'))
+
+  with selectors.DefaultSelector() as sel:
+    sel.register(rfd, selectors.EVENT_READ)
+    while True:
+      if not sel.select(timeout=1):
+        if p.poll() is not None:
+          # exited, but something it started may keep the pty open
+          break
+        continue
+
+      try:
+        r = os.read(rfd, 65536)
+      except OSError as e:
+        if e.errno == errno.EIO: # no clients of the pty left
           break
         else:
-          continue
-    except InterruptedError:
-      continue
-    except OSError as e:
-      if e.errno == 5: # Input/output error: no clients run
+          raise
+      if not r:
         break
-      else:
-        raise
-    r = r.replace(b'\x0f', b'') # ^O
-    if not silent:
-      sys.stderr.buffer.write(r)
-    out.append(r)
+
+      if not silent:
+        sys.stderr.buffer.write(r.replace(b'\x0f', b'')) # ^O
+      emit(cleaner.feed(r))
+    emit(cleaner.close())
 
   code = p.wait()
   if use_pty:
     os.close(rfd)
-  if old_hdl is not None:
-    signal.signal(signal.SIGCHLD, old_hdl)
+  else:
+    assert p.stdout is not None
+    p.stdout.close()
 
-  outb = b''.join(out)
-  outs = outb.decode('utf-8', errors='replace')
-  outs = outs.replace('\r\n', '\n')
-  outs = re.sub(r'.*\r', '', outs)
+  outs = window.getvalue()
   if code != 0:
       raise subprocess.CalledProcessError(code, cmd, outs)
   return outs
-
@@ -7,8 +7,8 @@ AUR_REPO_DIR.mkdir(parents=True, exist_ok=True)
 
 SPECIAL_FILES = ('package.list', 'lilac.py', 'lilac.yaml', '.gitignore')
 
+# package files lilac recognizes; the first one is built by default
+PACKAGE_EXTS = ('.pkg.tar.zst', '.pkg.tar.xz')
+
 _G = types.SimpleNamespace()
 # repo: Repo
-# mod: LilacMod
-# pkgver: Optional[str]
-# pkgrel: Optional[str]
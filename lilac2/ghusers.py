@@ -0,0 +1,131 @@
+'''
+GitHub user names and emails, cached on disk between runs
+'''
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple, Iterable
+
+from github import GitHub
+
+logger = logging.getLogger(__name__)
+
+UserInfo = Tuple[Optional[str], Optional[str]]
+
+class RateLimited(Exception):
+  def __init__(self, reset: float) -> None:
+    self.reset = reset
+
+  def __str__(self) -> str:
+    t = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.reset))
+    return f'GitHub API 达到速率限制，将于 {t} 恢复'
+
+class GitHubUsers:
+  '''Name and public email of GitHub users.
+
+  Entries younger than ``ttl`` seconds are used as-is. Older ones are
+  revalidated with their ETag, which doesn't count against the rate limit
+  when nothing has changed. While rate-limited, old entries are used and
+  users never seen raise :class:`RateLimited`.
+  '''
+
+  def __init__(
+    self, gh: GitHub, file: Path, ttl: float = 7 * 86400,
+  ) -> None:
+    self.gh = gh
+    self.file = file
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._limited_until = 0.0
+    try:
+      with open(file) as f:
+        self._users: Dict[str, Dict[str, Any]] = json.load(f)
+    except (FileNotFoundError, ValueError):
+      self._users = {}
+
+  def get(self, username: str) -> UserInfo:
+    return self._get(username, save=True)
+
+  def prefetch(self, usernames: Iterable[str], max_workers: int = 8) -> None:
+    '''look up users not in the cache or expired, at the same time'''
+    now = time.time()
+    with self._lock:
+      todo = {u for u in usernames
+              if u not in self._users
+              or now - self._users[u]['time'] >= self.ttl}
+    if not todo:
+      return
+
+    logger.info('fetching %d GitHub users', len(todo))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      fus = {u: executor.submit(self._get, u, False) for u in todo}
+    for u, fu in fus.items():
+      try:
+        fu.result()
+      except Exception as e:
+        logger.warning('failed to fetch GitHub user %s: %s', u, e)
+    self.save()
+
+  def save(self) -> None:
+    with self._lock:
+      data = json.dumps(self._users)
+    self.file.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=self.file.parent, prefix='.tmp')
+    with open(fd, 'w') as f:
+      f.write(data)
+    os.replace(tmpname, self.file)
+
+  def _get(self, username: str, save: bool) -> UserInfo:
+    now = time.time()
+    with self._lock:
+      cached = self._users.get(username)
+    if cached is not None and now - cached['time'] < self.ttl:
+      return cached['name'], cached['email']
+
+    try:
+      if now < self._limited_until:
+        raise RateLimited(self._limited_until)
+      entry = self._fetch(username, cached)
+    except RateLimited as e:
+      if cached is None:
+        raise
+      logger.warning('%s; using old info of GitHub user %s', e, username)
+      return cached['name'], cached['email']
+
+    with self._lock:
+      self._users[username] = entry
+    if save:
+      self.save()
+    return entry['name'], entry['email']
+
+  def _fetch(
+    self, username: str, cached: Optional[Dict[str, Any]],
+  ) -> Dict[str, Any]:
+    headers = {}
+    if cached is not None and cached.get('etag'):
+      headers['If-None-Match'] = cached['etag']
+    r = self.gh.api_request(f'/users/{username}', headers=headers)
+
+    if r.status_code == 304 and cached is not None:
+      return dict(cached, time=time.time())
+
+    if r.status_code in (403, 429) \
+       and r.headers.get('X-RateLimit-Remaining') == '0':
+      self._limited_until = float(
+        r.headers.get('X-RateLimit-Reset') or time.time() + 3600)
+      raise RateLimited(self._limited_until)
+
+    r.raise_for_status()
+    j = r.json()
+    return {
+      'time': time.time(),
+      'etag': r.headers.get('ETag'),
+      'name': j['name'],
+      'email': j['email'],
+    }
@@ -1,39 +1,30 @@
 import sys
+import ast
+import pickle
+import hashlib
 import contextlib
 import importlib.util
+from concurrent.futures import ProcessPoolExecutor, Future
 from pathlib import Path
-from typing import Generator, cast, Dict, Tuple
+from typing import Generator, cast, Dict, Tuple, Any, Optional, List
 
-from .typing import LilacMod, LilacMods, ExcInfo
-from .lilacyaml import load_lilac_yaml
-
-def load_all(repodir: Path) -> Tuple[LilacMods, Dict[str, ExcInfo]]:
-  mods = {}
-  errors = {}
+from myutils import safe_overwrite
 
-  for x in repodir.iterdir():
-    if not x.is_dir():
-      continue
-
-    if x.name[0] == '.':
-      continue
-
-    try:
-      with load_lilac(x) as mod:
-        mods[x.name] = mod
-      if hasattr(mod, 'time_limit_hours') and mod.time_limit_hours < 0:
-        raise ValueError('time_limit_hours should be positive.')
-    except FileNotFoundError:
-      pass
-    except Exception:
-      errors[x.name] = cast(ExcInfo, sys.exc_info())
+from .typing import LilacMod, LilacInfo, LilacInfos, ExcInfo
+from .lilacyaml import load_lilac_yaml
 
-  return mods, errors
+INFO_FIELDS = (
+  'update_on', 'depends', 'maintainers', 'time_limit_hours', 'build_prefix',
+  'check_interval',
+)
+INFO_FILES = ('lilac.py', 'lilac.yaml')
+# below this many directories to load, a process pool isn't worth starting
+PARALLEL_THRESHOLD = 32
 
 @contextlib.contextmanager
 def load_lilac(dir: Path) -> Generator[LilacMod, None, None]:
   try:
-    spec = importlib.util.spec_from_file_location( # type: ignore # Path is accepted too
+    spec = importlib.util.spec_from_file_location(
       'lilac.py', dir / 'lilac.py')
     mod = spec.loader.load_module() # type: ignore
 
@@ -51,3 +42,191 @@ def load_lilac(dir: Path) -> Generator[LilacMod, None, None]:
     except KeyError:
       pass
 
+def _scan_lilac_py(file: Path) -> Optional[Dict[str, Any]]:
+  '''find INFO_FIELDS in lilac.py without running it
+
+  Returns None if some of them are not simple literal assignments at
+  module level, or may be changed or imported there.
+  '''
+  with open(file, 'rb') as f:
+    tree = ast.parse(f.read(), str(file))
+
+  ret = {}
+  for node in tree.body:
+    if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+       and isinstance(node.targets[0], ast.Name) \
+       and node.targets[0].id in INFO_FIELDS:
+      try:
+        ret[node.targets[0].id] = ast.literal_eval(node.value)
+      except ValueError:
+        return None
+      continue
+
+    for n in _walk_module_level(node):
+      if _may_change_fields(n):
+        return None
+
+  return ret
+
+def _is_field(node: ast.AST) -> bool:
+  return isinstance(node, ast.Name) and node.id in INFO_FIELDS
+
+def _may_change_fields(node: ast.AST) -> bool:
+  if isinstance(node, ast.Name):
+    return node.id in INFO_FIELDS \
+        and isinstance(node.ctx, (ast.Store, ast.Del))
+  elif isinstance(node, ast.ImportFrom):
+    return any(
+      (a.name == '*' and node.module != 'lilaclib')
+      or (a.asname or a.name) in INFO_FIELDS
+      for a in node.names)
+  elif isinstance(node, ast.Import):
+    return any((a.asname or a.name) in INFO_FIELDS for a in node.names)
+  elif isinstance(node, (ast.Attribute, ast.Subscript)):
+    # e.g. update_on.append(...), maintainers[0] = ...
+    return _is_field(node.value)
+  elif isinstance(node, ast.Call):
+    # passed to something that may change it
+    return any(_is_field(a) for a in node.args) \
+        or any(_is_field(k.value) for k in node.keywords)
+  return False
+
+def _walk_module_level(node: ast.AST) -> Generator[ast.AST, None, None]:
+  # names bound inside functions and classes are not module attributes
+  if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                       ast.ClassDef, ast.Lambda)):
+    return
+  yield node
+  for child in ast.iter_child_nodes(node):
+    yield from _walk_module_level(child)
+
+def load_lilac_info(dir: Path) -> Tuple[LilacInfo, bool]:
+  '''load the LilacInfo for a package directory
+
+  The second return value tells if lilac.py had to be imported because its
+  fields can't be found statically, in which case the result shouldn't be
+  cached.
+  '''
+  fields = _scan_lilac_py(dir / 'lilac.py')
+  imported = fields is None
+  if fields is None:
+    with load_lilac(dir) as mod:
+      fields = {k: getattr(mod, k) for k in INFO_FIELDS if hasattr(mod, k)}
+  else:
+    yamlconf = load_lilac_yaml(dir)
+    fields.update((k, v) for k, v in yamlconf.items() if k in INFO_FIELDS)
+
+  info = LilacInfo(dir.name, **fields)
+  if info.time_limit_hours < 0:
+    raise ValueError('time_limit_hours should be positive.')
+  if info.check_interval is not None and info.check_interval <= 0:
+    raise ValueError('check_interval should be positive.')
+  return info, imported
+
+_Stat = Dict[str, Optional[Tuple[int, int]]]
+
+def _stat_files(dir: Path) -> _Stat:
+  ret: _Stat = {}
+  for name in INFO_FILES:
+    try:
+      st = (dir / name).stat()
+      ret[name] = st.st_mtime_ns, st.st_size
+    except FileNotFoundError:
+      ret[name] = None
+  return ret
+
+def _digest_files(dir: Path) -> str:
+  m = hashlib.sha1()
+  for name in INFO_FILES:
+    try:
+      with open(dir / name, 'rb') as f:
+        data = f.read()
+    except FileNotFoundError:
+      data = b''
+    m.update(b'%d:' % len(data))
+    m.update(data)
+  return m.hexdigest()
+
+def load_all_info(
+  repodir: Path, cachefile: Path, *, jobs: Optional[int] = 1,
+) -> Tuple[LilacInfos, Dict[str, ExcInfo]]:
+  '''load LilacInfo for every package, re-reading only changed directories
+
+  Entries in ``cachefile`` are keyed by the stat of lilac.py and
+  lilac.yaml, then by their content when the stat changes (e.g. after a
+  fresh checkout). Failures are not cached, and the whole cache is dropped
+  when INFO_FIELDS changes.
+
+  Directories that need loading are spread over ``jobs`` processes (None
+  for one per CPU) when there are many of them. Errors from those
+  processes carry the original traceback as their ``__cause__``. The
+  processes are forked, so call this before other threads are started.
+  '''
+  cache: Dict[str, Tuple[_Stat, str, LilacInfo]]
+  try:
+    with open(cachefile, 'rb') as f:
+      fields, cache = pickle.load(f)
+    if fields != INFO_FIELDS:
+      cache = {}
+  except (FileNotFoundError, EOFError, pickle.UnpicklingError, ValueError):
+    cache = {}
+
+  newcache = {}
+  infos = {}
+  errors = {}
+  to_load: List[Tuple[Path, _Stat, str]] = []
+
+  for x in repodir.iterdir():
+    if not x.is_dir():
+      continue
+
+    if x.name[0] == '.':
+      continue
+
+    stat = _stat_files(x)
+    if stat['lilac.py'] is None:
+      continue
+
+    cached = cache.get(x.name)
+    if cached is not None and cached[0] == stat:
+      infos[x.name] = cached[2]
+      newcache[x.name] = cached
+      continue
+
+    digest = _digest_files(x)
+    if cached is not None and cached[1] == digest:
+      infos[x.name] = cached[2]
+      newcache[x.name] = stat, digest, cached[2]
+      continue
+
+    to_load.append((x, stat, digest))
+
+  if jobs != 1 and len(to_load) >= PARALLEL_THRESHOLD:
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+      futures = [executor.submit(load_lilac_info, x) for x, _, _ in to_load]
+  else:
+    futures = []
+    for x, _, _ in to_load:
+      fu: Future = Future()
+      try:
+        fu.set_result(load_lilac_info(x))
+      except Exception as e:
+        fu.set_exception(e)
+      futures.append(fu)
+
+  for (x, stat, digest), fu in zip(to_load, futures):
+    try:
+      info, imported = fu.result()
+    except FileNotFoundError:
+      continue
+    except Exception:
+      errors[x.name] = cast(ExcInfo, sys.exc_info())
+      continue
+
+    infos[x.name] = info
+    if not imported:
+      newcache[x.name] = stat, digest, info
+
+  safe_overwrite(
+    str(cachefile), pickle.dumps((INFO_FIELDS, newcache)), mode='wb')
+  return infos, errors
@@ -0,0 +1,74 @@
+'''
+a pacman repository of the packages built in the current run
+
+Built packages are put here as soon as their build finishes, so builds
+depending on them use these copies. They stay put when the package
+directory is cleaned up for another build of the same package. Builds get
+the dependencies lilac resolved with ``-I``, all installed in one pacman
+transaction. Chroots of the pool also have the repository in their
+pacman.conf, so that other build dependencies are taken from here too.
+'''
+
+import os
+import shutil
+import logging
+import tarfile
+import threading
+from pathlib import Path
+from typing import Iterable, List
+
+from .cmd import run_cmd
+from .const import mydir
+from .typing import Cmd
+
+logger = logging.getLogger(__name__)
+
+LOCAL_REPO_DIR = mydir / 'localrepo'
+
+class LocalRepo:
+  def __init__(
+    self, dir: Path = LOCAL_REPO_DIR, name: str = 'lilac-local',
+  ) -> None:
+    self.dir = dir
+    self.name = name
+    self.db = dir / f'{name}.db.tar.gz'
+    # what pacman reads as the database
+    self.sync_db = dir / f'{name}.db'
+    self._lock = threading.Lock()
+
+  def reset(self) -> None:
+    '''forget packages of earlier runs'''
+    with self._lock:
+      shutil.rmtree(self.dir, ignore_errors=True)
+      self.dir.mkdir(parents=True)
+      # an empty database for pacman to sync before anything is built
+      tarfile.open(self.db, 'w:gz').close()
+      self.sync_db.symlink_to(self.db.name)
+
+  def add(self, files: Iterable[Path]) -> List[Path]:
+    '''put ``files`` into the repository and return their paths in it
+
+    Files of older versions of the same packages are removed.
+    '''
+    with self._lock:
+      ret = []
+      for f in files:
+        dst = self.dir / f.name
+        tmp = self.dir / f'.{f.name}.tmp'
+        try:
+          os.link(f, tmp)
+        except OSError:
+          # another filesystem or a leftover tmp file
+          shutil.copy2(f, tmp)
+        os.replace(tmp, dst)
+        ret.append(dst)
+
+      if ret:
+        try:
+          cmd: Cmd = ['repo-add', '--remove', '--quiet', self.db]
+          cmd.extend(ret)
+          run_cmd(cmd, silent=True)
+        except Exception:
+          # the files are still usable without the database
+          logger.exception('failed to update %s', self.db)
+      return ret
@@ -0,0 +1,181 @@
+'''
+compressed build logs under ~/.lilac/logs
+
+Each log is stored as ``<pkgbase>/<time>-<version>.log.zst`` (or ``.xz``
+when zstandard isn't installed) with a small JSON index next to it, which
+has the byte offsets of makepkg phases and of lines that look like errors.
+The logs are plain compressed streams, so taking an excerpt still
+decompresses the log from its start; the index only tells which lines to
+keep, and reading stops after the last of them.
+'''
+
+import os
+import re
+import json
+import time
+import lzma
+import logging
+from pathlib import Path
+from typing import BinaryIO, List, Tuple, Dict, Any, IO, cast
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+from .const import mydir
+from .tools import ansi_escape_re
+
+logger = logging.getLogger(__name__)
+
+LOG_DIR = mydir / 'logs'
+EXCERPT_SIZE = 4096
+
+_phase_re = re.compile(r'^==> (?!ERROR)')
+_error_re = re.compile(r'(?:error|Error|ERROR):|FAILED|==> ERROR')
+# error lines kept in the index from each end of a log
+_MAX_ERRORS = 50
+
+def _open(path: Path, mode: str) -> IO[bytes]:
+  if path.suffix == '.zst':
+    return cast(IO[bytes], zstandard.open(path, mode))
+  else:
+    return cast(IO[bytes], lzma.open(path, mode))
+
+def _index_path(path: Path) -> Path:
+  return path.with_name(path.name + '.json')
+
+def save_log(
+  log: BinaryIO, pkgbase: str, version: str, dir: Path = LOG_DIR,
+) -> Path:
+  '''compress ``log`` from its start into the store and return its path'''
+  suffix = '.zst' if zstandard is not None else '.xz'
+  ts = time.strftime('%Y%m%dT%H%M%S')
+  version = version.replace('/', '-')
+  path = dir / pkgbase / f'{ts}-{version}.log{suffix}'
+  path.parent.mkdir(parents=True, exist_ok=True)
+
+  phases: List[Tuple[int, str]] = []
+  errors: List[int] = []
+  nerrors = 0
+  offset = 0
+  log.seek(0)
+  with _open(path, 'wb') as f:
+    for l in log:
+      # makepkg colours its output when it's run with a pty
+      line = ansi_escape_re.sub('', l.decode('utf-8', errors='replace'))
+      if _phase_re.match(line):
+        phases.append((offset, line.strip()))
+      elif _error_re.search(line):
+        nerrors += 1
+        if len(errors) == 2 * _MAX_ERRORS:
+          del errors[_MAX_ERRORS]
+        errors.append(offset)
+      f.write(l)
+      offset += len(l)
+
+  index: Dict[str, Any] = {
+    'size': offset,
+    'phases': phases,
+    'errors': errors,
+    'error_count': nerrors,
+  }
+  with open(_index_path(path), 'w') as f:
+    json.dump(index, f)
+  return path
+
+def load_index(path: Path) -> Dict[str, Any]:
+  with open(_index_path(path)) as f:
+    return json.load(f)
+
+def excerpt(path: Path, size: int = EXCERPT_SIZE) -> str:
+  '''lines around the first and last errors of a stored log
+
+  Without error lines it's the end of the log. Each part is preceded by
+  the makepkg phase it's in.
+  '''
+  index = load_index(path)
+  errors = index['errors']
+  half = size // 4
+  if errors:
+    marks = sorted({errors[0], errors[-1]})
+    ranges = [(max(0, x - half), x + half) for x in marks]
+  else:
+    ranges = [(max(0, index['size'] - size), index['size'])]
+
+  # (offset, line) of each continuous part
+  regions: List[List[Tuple[int, str]]] = []
+  last_end = 0
+  offset = 0
+  end = ranges[-1][1]
+  with _open(path, 'rb') as f:
+    for l in f:
+      start = offset
+      if start >= end:
+        break
+      offset += len(l)
+      for a, b in ranges:
+        if a <= start < b:
+          break
+      else:
+        continue
+
+      if start > last_end or not regions:
+        regions.append([])
+      regions[-1].append((start, l.decode('utf-8', errors='replace')))
+      last_end = offset
+
+  # drop lines from the front to fit in ``size``, keeping a header for the
+  # first line that's left
+  phases = index['phases']
+  ret = ''
+  for lines in reversed(regions):
+    room = size - len(ret)
+    total = sum(len(l) for _, l in lines)
+    i = 0
+    while (i < len(lines)
+           and total + len(_header(phases, lines[i][0])) > room):
+      total -= len(lines[i][1])
+      i += 1
+    if i == len(lines):
+      break
+    ret = _header(phases, lines[i][0]) + ''.join(
+      l for _, l in lines[i:]) + ret
+    if i:
+      break
+
+  if not ret and regions:
+    # a single line longer than ``size``
+    ret = regions[-1][-1][1][-size:]
+  return ret
+
+def _header(phases: List[Tuple[int, str]], start: int) -> str:
+  '''the makepkg phase the line at ``start`` is in'''
+  header = '……\n' if start > 0 else ''
+  phase = [p for o, p in phases if o < start]
+  if phase:
+    header += phase[-1] + '\n……\n'
+  return header
+
+def prune(max_age_days: int = 30, dir: Path = LOG_DIR) -> None:
+  '''remove logs older than ``max_age_days``'''
+  deadline = time.time() - max_age_days * 86400
+  try:
+    pkgdirs = list(os.scandir(dir))
+  except FileNotFoundError:
+    return
+
+  for d in pkgdirs:
+    if not d.is_dir():
+      continue
+    for e in os.scandir(d.path):
+      try:
+        if e.stat().st_mtime < deadline:
+          os.unlink(e.path)
+      except FileNotFoundError:
+        pass
+    try:
+      os.rmdir(d.path)
+    except OSError:
+      # not empty
+      pass
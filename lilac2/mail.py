@@ -1,20 +1,55 @@
+import os
+import json
+import time
+import queue
+import logging
 import smtplib
-from typing import Union, Type, List
+import threading
+import itertools
+from collections import defaultdict
+from pathlib import Path
+from typing import Union, Type, List, Optional, Dict, Tuple
 
 from mailutils import assemble_mail
 
+from .const import mydir
+
+logger = logging.getLogger(__name__)
+
 SMTPClient = Union[smtplib.SMTP, smtplib.SMTP_SSL]
+SPOOL_DIR = mydir / 'mailspool'
+# close the SMTP connection after this many seconds without mails
+IDLE_TIMEOUT = 30
+
+_Recipients = Tuple[str, ...]
 
 class MailService:
-  def __init__(self, config) -> None:
+  '''Send mails from a background thread over one SMTP connection.
+
+  Every mail is written to ``spool`` first and removed once sent, so mails
+  of a run that crashed can be sent by :meth:`recover` in the next one.
+  With ``digest = yes`` in ``[smtp]``, mails are held until :meth:`flush`
+  and sent as one mail per recipient list.
+  '''
+
+  def __init__(self, config, spool: Path = SPOOL_DIR) -> None:
     self.config = config
     self.mailtag = config.get('lilac', 'name')
     self.send_email = config.getboolean('lilac', 'send_email')
+    self.digest = config.getboolean('smtp', 'digest', fallback=False)
+    self.spool = spool
 
     myname = config.get('lilac', 'name')
     myaddress = config.get('lilac', 'email')
     self.from_ = f'{myname} <{myaddress}>'
 
+    # the mail thread and its own queue; a new pair is made after flush()
+    self._sender: Optional[Tuple[threading.Thread, queue.Queue]] = None
+    self._digests: Dict[_Recipients, List[Tuple[str, str, Path]]] = \
+        defaultdict(list)
+    self._lock = threading.Lock()
+    self._counter = itertools.count()
+
   def smtp_connect(self) -> SMTPClient:
     config = self.config
     host = config.get('smtp', 'host', fallback='')
@@ -36,15 +71,138 @@ class MailService:
 
   def sendmail(self, to: Union[str, List[str]],
                subject: str, msg: str) -> None:
+    '''queue a mail; it's sent later from the mail thread'''
     if not self.send_email:
       return
 
-    s = self.smtp_connect()
+    file = self._write_spool(to, subject, msg)
+    if self.digest:
+      key = (to,) if isinstance(to, str) else tuple(to)
+      with self._lock:
+        self._digests[key].append((subject, msg, file))
+    else:
+      self._enqueue(to, subject, msg, [file])
+
+  def flush(self) -> None:
+    '''send held digests and wait until all queued mails are sent'''
+    with self._lock:
+      digests, self._digests = self._digests, defaultdict(list)
+
+    for to, items in digests.items():
+      if len(items) == 1:
+        subject, msg, file = items[0]
+      else:
+        subject = f'本次运行的 {len(items)} 份报告'
+        msg = '\n\n'.join(
+          f'===== {subject} =====\n\n{msg}' for subject, msg, _ in items)
+      self._enqueue(list(to), subject, msg, [x[2] for x in items])
+
+    with self._lock:
+      sender, self._sender = self._sender, None
+    if sender is not None:
+      thread, q = sender
+      q.put(None)
+      thread.join()
+
+  def recover(self) -> None:
+    '''queue mails left in the spool by a run that didn't finish'''
+    try:
+      files = sorted(self.spool.iterdir())
+    except FileNotFoundError:
+      return
+
+    for file in files:
+      if file.suffix != '.json':
+        continue
+      try:
+        with open(file) as f:
+          m = json.load(f)
+      except ValueError:
+        logger.warning('removing broken spooled mail %s', file)
+        file.unlink()
+        continue
+      logger.info('sending spooled mail %r', m['subject'])
+      self._enqueue(m['to'], m['subject'], m['msg'], [file])
+
+  def _write_spool(
+    self, to: Union[str, List[str]], subject: str, msg: str,
+  ) -> Path:
+    self.spool.mkdir(parents=True, exist_ok=True)
+    name = f'{time.time_ns()}-{os.getpid()}-{next(self._counter)}'
+    file = self.spool / f'{name}.json'
+    tmp = self.spool / f'{name}.tmp'
+    with open(tmp, 'w') as f:
+      json.dump({'to': to, 'subject': subject, 'msg': msg}, f)
+    os.rename(tmp, file)
+    return file
+
+  def _enqueue(
+    self, to: Union[str, List[str]], subject: str, msg: str,
+    files: List[Path],
+  ) -> None:
+    with self._lock:
+      if self._sender is None:
+        q: queue.Queue = queue.Queue()
+        thread = threading.Thread(
+          target=self._run, args=(q,), name='mail', daemon=True)
+        thread.start()
+        self._sender = thread, q
+      # under the lock so that it can't miss a flush() going on
+      self._sender[1].put((to, subject, msg, files))
+
+  def _run(self, q: queue.Queue) -> None:
+    s: Optional[SMTPClient] = None
+    while True:
+      try:
+        item = q.get(timeout=IDLE_TIMEOUT)
+      except queue.Empty:
+        self._quit(s)
+        s = None
+        continue
+      if item is None:
+        break
+
+      to, subject, msg, files = item
+      try:
+        s = self._send(s, to, subject, msg)
+      except Exception:
+        logger.exception('failed to send mail %r; it stays in the spool',
+                         subject)
+        self._quit(s)
+        s = None
+        continue
+      for file in files:
+        try:
+          file.unlink()
+        except FileNotFoundError:
+          pass
+
+    self._quit(s)
+
+  def _send(
+    self, s: Optional[SMTPClient],
+    to: Union[str, List[str]], subject: str, msg: str,
+  ) -> SMTPClient:
     if len(msg) > 5 * 1024 ** 2:
       msg = msg[:1024 ** 2] + '\n\n日志过长，省略ing……\n\n' + \
           msg[-1024 ** 2:]
     mail = assemble_mail('[%s] %s' % (
       self.mailtag, subject), to, self.from_, text=msg)
+
+    if s is not None:
+      try:
+        s.send_message(mail)
+        return s
+      except smtplib.SMTPServerDisconnected:
+        pass
+
+    s = self.smtp_connect()
     s.send_message(mail)
-    s.quit()
+    return s
 
+  def _quit(self, s: Optional[SMTPClient]) -> None:
+    if s is not None:
+      try:
+        s.quit()
+      except smtplib.SMTPException:
+        pass
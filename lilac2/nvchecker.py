@@ -1,5 +1,10 @@
 import configparser
 import os
+import time
+import queue
+import hashlib
+import threading
+import statistics
 import traceback
 import logging
 from collections import defaultdict
@@ -7,11 +12,12 @@ import subprocess
 import json
 from pathlib import Path
 from typing import List, NamedTuple, Tuple, Set, Dict
-from typing import Optional, Any, Union, Iterable
+from typing import Optional, Any, Union, Iterable, Callable, IO
+
+from myutils import safe_overwrite
 
-from .cmd import run_cmd
 from .const import mydir
-from .typing import LilacMods, PathLike
+from .typing import LilacInfos, PathLike
 from .repo import Repo, Maintainer
 
 logger = logging.getLogger(__name__)
@@ -19,6 +25,18 @@ logger = logging.getLogger(__name__)
 NVCHECKER_FILE: Path = mydir / 'nvchecker.ini'
 OLDVER_FILE = mydir / 'oldver'
 NEWVER_FILE = mydir / 'newver'
+_oldver_lock = threading.Lock()
+# entry name -> [time checked, version, digest of its configuration]
+NVCHECKER_CACHE = mydir / 'nvchecker-cache.json'
+
+DEFAULT_SHARD = 'default'
+# in the order nvchecker looks for them
+NVCHECKER_SOURCES = (
+  'github', 'aur', 'pypi', 'archpkg', 'debianpkg', 'ubuntupkg', 'gems',
+  'pacman', 'cmd', 'bitbucket', 'regex', 'manual', 'vcs', 'cratesio', 'npm',
+  'hackage', 'cpan', 'gitlab', 'packagist', 'repology', 'anitya',
+  'android_sdk', 'sparkle', 'gitea',
+)
 
 class NvResult(NamedTuple):
   oldver: Optional[str]
@@ -32,7 +50,7 @@ def _gen_config_from_ini(repo, U):
   except Exception:
     tb = traceback.format_exc()
     try:
-      who = repo.find_maintainer(file='nvchecker.ini')
+      who = repo.find_maintainer_by_git('nvchecker.ini')
       more = ''
     except Exception:
       who = repo.mymaster
@@ -55,7 +73,7 @@ def _gen_config_from_ini(repo, U):
   return newconfig, unknown
 
 def _gen_config_from_mods(
-  repo: Repo, mods: LilacMods,
+  repo: Repo, mods: LilacInfos,
 ) -> Tuple[Dict[str, Any], Set[str]]:
   unknown = set()
   newconfig = {}
@@ -73,9 +91,157 @@ def _gen_config_from_mods(
 
   return newconfig, unknown
 
+def read_verfile(file: Path) -> Dict[str, str]:
+  vers = {}
+  try:
+    with open(file) as f:
+      for l in f:
+        name, ver = l.rstrip('\n').split(None, 1)
+        vers[name] = ver
+  except FileNotFoundError:
+    pass
+  return vers
+
+def write_verfile(file: Path, vers: Dict[str, str]) -> None:
+  data = ''.join(f'{name} {ver}\n' for name, ver in sorted(vers.items()))
+  safe_overwrite(str(file), data)
+
+def _load_cache() -> Dict[str, List[Any]]:
+  try:
+    with open(NVCHECKER_CACHE) as f:
+      return json.load(f)
+  except (FileNotFoundError, ValueError):
+    return {}
+
+def _config_digest(conf) -> str:
+  data = json.dumps(dict(conf), sort_keys=True, default=str)
+  return hashlib.sha1(data.encode()).hexdigest()
+
+def _take_not_due(
+  newconfig: Dict[str, Any], mods: LilacInfos,
+  cache: Dict[str, List[Any]], digests: Dict[str, str],
+) -> Dict[str, str]:
+  '''remove entries of packages not due for checking from ``newconfig``
+
+  A package is due if it has no ``check_interval``, or any of its entries
+  has no cached result, a changed configuration or one older than that.
+  Returns the cached versions of the removed entries.
+  '''
+  now = time.time()
+  entries: Dict[str, List[str]] = defaultdict(list)
+  for name in newconfig:
+    entries[name.split(':', 1)[0]].append(name)
+
+  ret = {}
+  for pkg, names in entries.items():
+    interval = getattr(mods.get(pkg), 'check_interval', None)
+    if not interval:
+      continue
+    versions = {}
+    for name in names:
+      c = cache.get(name)
+      if c is None or c[2] != digests[name] or now - c[0] >= interval * 3600:
+        break
+      versions[name] = c[1]
+    else:
+      for name in names:
+        del newconfig[name]
+      ret.update(versions)
+
+  return ret
+
+def _write_config(
+  file: Path, entries: Dict[str, Any], config: Dict[str, Any],
+) -> None:
+  new = configparser.ConfigParser(
+    dict_type=dict, allow_no_value=True)
+  new.read_dict(dict(entries, __config__=config))
+  with open(file, 'w') as f:
+    new.write(f)
+
+def _source_of(conf) -> Optional[str]:
+  for source in NVCHECKER_SOURCES:
+    if source in conf:
+      return source
+  return None
+
+def _split_shards(
+  newconfig: Dict[str, Any], shards: Dict[str, Optional[int]],
+) -> Dict[str, Dict[str, Any]]:
+  ret: Dict[str, Dict[str, Any]] = defaultdict(dict)
+  for name, conf in newconfig.items():
+    source = _source_of(conf)
+    shard = source if source in shards else DEFAULT_SHARD
+    ret[shard][name] = conf
+  return ret
+
+def _shard_file(kind: str, shard: str) -> Path:
+  return mydir / f'{kind}-{shard}'
+
+def _read_events(
+  shard: str, output: IO[str], events: queue.Queue,
+) -> None:
+  try:
+    with output:
+      for l in output:
+        events.put((shard, json.loads(l)))
+  finally:
+    events.put((shard, None))
+
+def _start_nvchecker(
+  repo: Repo, shard: str, entries: Dict[str, Any],
+  max_concurrent: Optional[int], events: queue.Queue,
+) -> Tuple[str, subprocess.Popen, List[Union[str, PathLike]]]:
+  config: Dict[str, Any] = {
+    'oldver': OLDVER_FILE,
+    'newver': _shard_file('newver', shard),
+  }
+  if max_concurrent:
+    config['max_concurrent'] = max_concurrent
+  file = _shard_file('nvchecker', shard).with_suffix('.ini')
+  _write_config(file, entries, config)
+
+  # vcs source needs to be run in the repo, so cwd=...
+  rfd, wfd = os.pipe()
+  cmd: List[Union[str, PathLike]] = [
+    'nvchecker', '--logger', 'both', '--json-log-fd', str(wfd), file]
+  process = subprocess.Popen(
+    cmd, cwd=repo.repodir, pass_fds=(wfd,))
+  os.close(wfd)
+
+  threading.Thread(
+    target = _read_events, args = (shard, os.fdopen(rfd), events),
+    daemon = True,
+  ).start()
+  return shard, process, cmd
+
+def shards_from_config(config) -> Dict[str, Optional[int]]:
+  '''nvchecker shards and their max_concurrent from the [nvchecker] section'''
+  default = config.getint('nvchecker', 'max_concurrent', fallback=None)
+  ret = {DEFAULT_SHARD: default}
+  for shard in config.get('nvchecker', 'shards', fallback='').split():
+    ret[shard] = config.getint(
+      'nvchecker', f'{shard}_max_concurrent', fallback=default)
+  return ret
+
 def packages_need_update(
-  repo: Repo, mods: LilacMods,
+  repo: Repo, mods: LilacInfos,
+  on_result: Optional[Callable[[str, int, NvResult], None]] = None,
+  shards: Optional[Dict[str, Optional[int]]] = None,
 ) -> Tuple[Dict[str, NvResult], Set[str], Set[str]]:
+  '''run nvchecker for ``mods``
+
+  ``on_result(pkg, i, result)`` is called from this thread as soon as an
+  ``update_on`` entry ``i`` of ``pkg`` is known to be updated or up to
+  date, before nvchecker finishes.
+
+  Packages with a ``check_interval`` that isn't over yet are not checked;
+  their last results are used instead.
+
+  Entries are checked by one nvchecker process per shard at the same time.
+  ``shards`` maps source types (e.g. ``github``) to the ``max_concurrent``
+  of their process; sources not listed go to the ``default`` shard.
+  '''
   newconfig, left = _gen_config_from_mods(repo, mods)
   newconfig2, unknown = _gen_config_from_ini(repo, left)
   newconfig.update(newconfig2)
@@ -84,54 +250,114 @@ def packages_need_update(
   if not OLDVER_FILE.exists():
     open(OLDVER_FILE, 'a').close()
 
-  newconfig['__config__'] = {
+  cache = _load_cache()
+  digests = {name: _config_digest(conf) for name, conf in newconfig.items()}
+  not_due = _take_not_due(newconfig, mods, cache, digests)
+  if not_due:
+    logger.info('%d entries are not due for checking', len(not_due))
+
+  # the full configuration, for running nvchecker and nvtake by hand
+  _write_config(NVCHECKER_FILE, newconfig, {
     'oldver': OLDVER_FILE,
     'newver': NEWVER_FILE,
-  }
+  })
 
-  new = configparser.ConfigParser( # type: ignore
-    dict_type=dict, allow_no_value=True)
-  new.read_dict(newconfig)
-  with open(NVCHECKER_FILE, 'w') as f:
-    new.write(f)
+  nvdata: Dict[str, NvResult] = {}
+  errors: Dict[Optional[str], List[Dict[str, Any]]] = defaultdict(list)
+  rebuild: Set[str] = set()
 
-  # vcs source needs to be run in the repo, so cwd=...
-  rfd, wfd = os.pipe()
-  cmd: List[Union[str, PathLike]] = [
-    'nvchecker', '--logger', 'both', '--json-log-fd', str(wfd),
-    NVCHECKER_FILE]
-  logger.info('Running nvchecker...')
-  process = subprocess.Popen(
-    cmd, cwd=repo.repodir, pass_fds=(wfd,))
-  os.close(wfd)
+  oldvers = read_verfile(OLDVER_FILE)
+  for name, version in not_due.items():
+    pkg, i = _split_name(name)
+    assert pkg is not None
+    r = NvResult(oldvers.get(name), version)
+    if i == 0:
+      nvdata[pkg] = r
+    elif r.oldver != r.newver:
+      rebuild.add(pkg)
+    if on_result is not None:
+      on_result(pkg, i, r)
 
-  output = os.fdopen(rfd)
-  nvdata = {}
-  errors: Dict[Optional[str], List[Dict[str, Any]]] = defaultdict(list)
-  rebuild = set()
-  for l in output:
-    j = json.loads(l)
-    pkg = j.get('name')
-    if pkg and ':' in pkg:
-      pkg, i = pkg.split(':', 1)
-      i = int(i)
-    else:
-      i = 0
-    event = j['event']
-    if event == 'updated':
-      if i == 0:
-        nvdata[pkg] = NvResult(j['old_version'], j['version'])
+  if shards is None:
+    shards = {DEFAULT_SHARD: None}
+  shard_configs = _split_shards(newconfig, shards)
+  start = time.time()
+  events: queue.Queue = queue.Queue()
+  processes = []
+  # seconds until each result arrives, by shard
+  latencies: Dict[str, List[float]] = defaultdict(list)
+  try:
+    for shard, conf in shard_configs.items():
+      logger.info('Running nvchecker for %d entries in shard %s...',
+                  len(conf), shard)
+      processes.append(
+        _start_nvchecker(repo, shard, conf, shards.get(shard), events))
+
+    running = len(processes)
+    while running:
+      shard, j = events.get()
+      if j is None:
+        running -= 1
+        continue
+
+      name = j.get('name')
+      pkg, i = _split_name(name)
+      event = j['event']
+      if event not in ['updated', 'up-to-date']:
+        if j['level'] in ['warn', 'error', 'exception', 'critical']:
+          errors[pkg].append(j)
+        continue
+
+      # results always have a name
+      assert name is not None and pkg is not None
+      cache[name] = [time.time(), j['version'], digests.get(name)]
+      latencies[shard].append(time.time() - start)
+      if event == 'updated':
+        r = NvResult(j['old_version'], j['version'])
+        if i == 0:
+          nvdata[pkg] = r
+        else:
+          rebuild.add(pkg)
       else:
-        rebuild.add(pkg)
-    elif event == 'up-to-date':
-      if i == 0:
-        nvdata[pkg] = NvResult(j['version'], j['version'])
-    elif j['level'] in ['warn', 'error', 'exception', 'critical']:
-      errors[pkg].append(j)
+        r = NvResult(j['version'], j['version'])
+        if i == 0:
+          nvdata[pkg] = r
+
+      if on_result is not None:
+        on_result(pkg, i, r)
+
+    for shard, process, cmd in processes:
+      ret = process.wait()
+      if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+      ls = latencies[shard]
+      logger.info(
+        'nvchecker shard %s: %d of %d entries checked, '
+        'median %.1fs, last %.1fs',
+        shard, len(ls), len(shard_configs[shard]),
+        statistics.median(ls) if ls else 0, max(ls, default=0),
+      )
+  finally:
+    # don't leave other shards running when one of them (or we) failed;
+    # their reader threads end with the pipes
+    for _, process, _ in processes:
+      if process.poll() is None:
+        process.terminate()
+      process.wait()
+  logger.info('checking for updates took %.1fs', time.time() - start)
 
-  ret = process.wait()
-  if ret != 0:
-    raise subprocess.CalledProcessError(ret, cmd)
+  # forget packages that are gone
+  cache = {k: v for k, v in cache.items() if k in digests}
+  safe_overwrite(str(NVCHECKER_CACHE), json.dumps(cache), mode='w')
+
+  # nvchecker starts its newver file from oldver
+  newvers = dict(oldvers)
+  for shard, conf in shard_configs.items():
+    shardvers = read_verfile(_shard_file('newver', shard))
+    newvers.update((k, v) for k, v in shardvers.items() if k in conf)
+  # nvchecker doesn't know these; make nvtake take the cached versions
+  newvers.update(not_due)
+  write_verfile(NEWVER_FILE, newvers)
 
   missing = []
   error_owners: Dict[Maintainer, List[Dict[str, Any]]] = defaultdict(list)
@@ -177,6 +403,13 @@ def packages_need_update(
 
   return nvdata, unknown, rebuild
 
+def _split_name(name: Optional[str]) -> Tuple[Optional[str], int]:
+  if name and ':' in name:
+    pkg, i = name.split(':', 1)
+    return pkg, int(i)
+  else:
+    return name, 0
+
 def _format_error(error) -> str:
   if 'exception' in error:
     exception = error['exception']
@@ -190,7 +423,14 @@ def _format_error(error) -> str:
     ret += '\n' + exception + '\n'
   return ret
 
-def nvtake(L: Iterable[str], mods: LilacMods) -> None:
+def nvtake(
+  L: Iterable[str], mods: LilacInfos, newvers: Dict[str, str],
+) -> None:
+  '''record versions in ``newvers`` of packages in ``L`` as taken
+
+  The oldver file is replaced atomically, so it can be called after each
+  build, from several threads.
+  '''
   names: List[str] = []
   for name in L:
     confs = getattr(mods[name], 'update_on', None)
@@ -200,7 +440,9 @@ def nvtake(L: Iterable[str], mods: LilacMods) -> None:
     else:
       names.append(name)
 
-  run_cmd(['nvtake', '--ignore-nonexistent', NVCHECKER_FILE] # type: ignore
-          + names)
-  # mypy can't infer List[Union[str, Path]]
-  # and can't understand List[str] is a subtype of it
+  with _oldver_lock:
+    oldvers = read_verfile(OLDVER_FILE)
+    for name in names:
+      if name in newvers:
+        oldvers[name] = newvers[name]
+    write_verfile(OLDVER_FILE, oldvers)
@@ -1,9 +1,18 @@
-from collections import defaultdict, namedtuple
-from typing import Dict
+import os
+import threading
+import subprocess
+from collections import defaultdict
+from pathlib import Path
+from typing import (
+  Dict, Tuple, Optional, Iterable, Union, NamedTuple, Set, List,
+)
 
 import archpkg
+import pyalpm
 
 from .api import run_cmd
+from .const import PACKAGE_EXTS
+from .typing import Cmd
 
 def get_dependency_map(depman, mods):
   map = defaultdict(set)
@@ -24,58 +33,144 @@ def get_dependency_map(depman, mods):
 
   return map
 
-_DependencyTuple = namedtuple(
-  '_DependencyTuple', 'pkgdir pkgname')
-
-class Dependency(_DependencyTuple):
-  def resolve(self):
+class BuiltPackages:
+  '''Newest built package file for each package directory and pkgname.
+
+  It's filled by one scan of the repository, then kept up to date by
+  calling :meth:`replace_dir` when a build produces new files.
+  '''
+
+  def __init__(self) -> None:
+    self._pkgs: Dict[
+      Tuple[Path, str], Tuple[archpkg.PkgNameInfo, Path]] = {}
+    self._lock = threading.Lock()
+
+  @classmethod
+  def scan(cls, repodir: Path) -> 'BuiltPackages':
+    self = cls()
+    with os.scandir(repodir) as pkgdirs:
+      for d in pkgdirs:
+        if d.name[0] == '.' or not d.is_dir():
+          continue
+        with os.scandir(d.path) as files:
+          for f in files:
+            if f.name.endswith(PACKAGE_EXTS):
+              self.add(Path(d.path), Path(f.path))
+    return self
+
+  def add(self, pkgdir: Path, path: Path) -> None:
+    '''add ``path`` built in ``pkgdir``; it may be stored elsewhere'''
     try:
-      r = self._find_local_package()
-    except FileNotFoundError:
-      r = None
-    return r
-
-  def managed(self):
+      info = archpkg.PkgNameInfo.parseFilename(path.name)
+    except TypeError:
+      # not in the name-version-release-arch form
+      return
+
+    key = pkgdir, info.name
+    with self._lock:
+      old = self._pkgs.get(key)
+      if old is None or pyalpm.vercmp(
+        info.fullversion, old[0].fullversion) > 0:
+        self._pkgs[key] = info, path
+
+  def replace_dir(self, pkgdir: Path, files: Iterable[Path]) -> None:
+    '''forget what was built in ``pkgdir`` and add ``files`` instead'''
+    with self._lock:
+      self._pkgs = {k: v for k, v in self._pkgs.items()
+                    if k[0] != pkgdir}
+    for f in files:
+      self.add(pkgdir, f)
+
+  def get(self, pkgdir: Path, pkgname: str) -> Optional[Path]:
+    key = pkgdir, pkgname
+    r = self._pkgs.get(key)
+    if r is None:
+      return None
+    path = r[1]
+    if not path.exists():
+      # cleaned up by a later build that hasn't succeeded
+      with self._lock:
+        self._pkgs.pop(key, None)
+      return None
+    return path
+
+class Dependency:
+  def __init__(
+    self, pkgdir: Path, pkgname: str, built: BuiltPackages,
+  ) -> None:
+    self.pkgdir = pkgdir
+    self.pkgname = pkgname
+    self._built = built
+
+  def __repr__(self) -> str:
+    return f'Dependency(pkgdir={self.pkgdir!r}, pkgname={self.pkgname!r})'
+
+  def resolve(self) -> Optional[Path]:
+    return self._built.get(self.pkgdir, self.pkgname)
+
+  def managed(self) -> bool:
     return (self.pkgdir / 'lilac.py').exists()
 
-  def _find_local_package(self):
-    files = [x for x in self.pkgdir.iterdir()
-              if x.name.endswith('.pkg.tar.xz')]
-    pkgs = []
-    for x in files:
-      info = archpkg.PkgNameInfo.parseFilename(x.name)
-      if info.name == self.pkgname:
-        pkgs.append(x)
-
-    if len(pkgs) == 1:
-      return pkgs[0]
-    elif not pkgs:
-      raise FileNotFoundError
-    else:
-      ret = sorted(
-        pkgs, reverse=True, key=lambda x: x.stat().st_mtime)[0]
-      return ret
-
 class DependencyManager:
-  _CACHE: Dict[str, Dependency] = {}
-
-  def __init__(self, repodir):
+  def __init__(self, repodir: Path, built: BuiltPackages) -> None:
     self.repodir = repodir
+    self.built = built
+    self._cache: Dict[str, Dependency] = {}
 
-  def get(self, what):
+  def get(self, what: Union[str, Tuple[str, str]]) -> Dependency:
     if isinstance(what, tuple):
       pkgbase, pkgname = what
     else:
       pkgbase = pkgname = what
 
-    if pkgname not in self._CACHE:
-      self._CACHE[pkgname] = Dependency(
-        self.repodir / pkgbase, pkgname)
-    return self._CACHE[pkgname]
-
-def get_changed_packages(revisions):
-  cmd = ["git", "diff", "--name-only", revisions]
-  r = run_cmd(cmd).splitlines()
-  ret = {x.split('/', 1)[0] for x in r}
-  return ret
-
+    if pkgname not in self._cache:
+      self._cache[pkgname] = Dependency(
+        self.repodir / pkgbase, pkgname, self.built)
+    return self._cache[pkgname]
+
+class RepoChanges(NamedTuple):
+  # top-level directories with any change
+  changed: Set[str]
+  # packages whose PKGBUILD sets a new pkgrel
+  pkgrel_bumped: Set[str]
+  # diff lines of each changed PKGBUILD, without the file headers
+  pkgbuild_diffs: Dict[str, List[str]]
+
+def get_changes(revisions: str) -> RepoChanges:
+  '''what has changed in ``revisions``, with one diff of all PKGBUILDs'''
+  cmd: Cmd = ["git", "diff", "--name-only", revisions]
+  changed = {x.split('/', 1)[0] for x in run_cmd(cmd).splitlines()}
+
+  diffs: Dict[str, List[str]] = {}
+  cmd = ["git", "diff", "-p", revisions, '--', ':(glob)*/PKGBUILD']
+  with subprocess.Popen(
+    cmd, stdout=subprocess.PIPE, universal_newlines=True,
+    errors='replace',
+  ) as p:
+    assert p.stdout is not None
+    pkg = ''
+    in_header = False
+    for l in p.stdout:
+      l = l.rstrip('\n')
+      if l.startswith('diff --git '):
+        in_header = True
+        continue
+      if in_header:
+        if l.startswith(('--- a/', '+++ b/')):
+          # a deleted file has no "+++ b/" line and a new one no "--- a/"
+          pkg = l[6:].split('/', 1)[0]
+          continue
+        elif l.startswith('@@'):
+          in_header = False
+        else:
+          continue
+      diffs.setdefault(pkg, []).append(l)
+
+  if p.returncode != 0:
+    raise subprocess.CalledProcessError(p.returncode, cmd)
+
+  pkgrel_bumped = {
+    pkg for pkg, ls in diffs.items()
+    if any(x.startswith('+pkgrel=') for x in ls)
+  }
+  return RepoChanges(changed, pkgrel_bumped, diffs)
@@ -1,23 +1,59 @@
 # PKGBUILD related stuff that lilac uses (excluding APIs)
 
 import os
+import re
+import time
+import pickle
+import hashlib
+import logging
+import tempfile
 import subprocess
-from typing import List, Set, Tuple
+from pathlib import Path
+from typing import List, Set, Tuple, Optional, Dict, FrozenSet, NamedTuple
 
 import pyalpm
 
-from .const import _G
+from myutils import safe_overwrite
+
+from .const import mydir
+from .typing import PathLike
+
+logger = logging.getLogger(__name__)
 
 _official_repos = ['core', 'extra', 'community', 'multilib']
 _official_packages: Set[str] = set()
 _official_groups: Set[str] = set()
+# packages official ones declare to replace
+_official_replaces: Set[str] = set()
+
+OFFICIAL_INDEX = mydir / 'official-index.pickle'
+
+class _RepoIndex(NamedTuple):
+  # (st_mtime_ns, st_size) of the sync database this is read from
+  dbstat: Tuple[int, int]
+  packages: FrozenSet[str]
+  groups: FrozenSet[str]
+  replaces: FrozenSet[str]
+
+SRCINFO_CACHE_DIR = mydir / 'srcinfo'
+# bump this when what affects makepkg --printsrcinfo output changes
+_SRCINFO_CACHE_VERSION = b'1'
+_sourced_file_re = re.compile(
+  r'''^\s*(?:\.|source)\s+["']?([^"'\s;&|]+)''', re.MULTILINE)
 
 class ConflictWithOfficialError(Exception):
-  def __init__(self, groups, packages):
+  def __init__(self, groups, packages, replaced=()):
     self.groups = groups
     self.packages = packages
+    self.replaced = replaced
 
-def init_data(dbpath: os.PathLike) -> None:
+def update_data(dbpath: os.PathLike) -> None:
+  '''sync the official databases and update the index from them
+
+  pacman only downloads databases that have changed, and only repos whose
+  database has changed are read again. If syncing fails but there is an
+  index from an earlier run, that one is used.
+  '''
   for _ in range(3):
     p = subprocess.run(
       ['fakeroot', 'pacman', '-Sy', '--dbpath', dbpath],
@@ -25,22 +61,74 @@ def init_data(dbpath: os.PathLike) -> None:
     if p.returncode == 0:
       break
   else:
+    if OFFICIAL_INDEX.exists():
+      logger.warning('failed to sync pacman databases, '
+                     'using the official package index as-is.')
+      return
     p.check_returncode()
 
-  H = pyalpm.Handle('/', str(dbpath))
+  _update_index(dbpath)
+
+def _load_index() -> Dict[str, _RepoIndex]:
+  try:
+    with open(OFFICIAL_INDEX, 'rb') as f:
+      return pickle.load(f)
+  except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+    return {}
+
+def _strip_ver(s: str) -> str:
+  return re.sub(r'[<>=].*', '', s)
+
+def _update_index(dbpath: os.PathLike) -> None:
+  index = _load_index()
+  H = None
+  changed = False
+
   for repo in _official_repos:
+    st = (Path(dbpath) / 'sync' / f'{repo}.db').stat()
+    dbstat = st.st_mtime_ns, st.st_size
+    old = index.get(repo)
+    if old is not None and old.dbstat == dbstat:
+      continue
+
+    logger.info('indexing official repository %s', repo)
+    if H is None:
+      H = pyalpm.Handle('/', str(dbpath))
     db = H.register_syncdb(repo, 0)
-    _official_packages.update(p.name for p in db.pkgcache)
-    _official_groups.update(g[0] for g in db.grpcache)
+    index[repo] = _RepoIndex(
+      dbstat = dbstat,
+      packages = frozenset(p.name for p in db.pkgcache),
+      groups = frozenset(g[0] for g in db.grpcache),
+      replaces = frozenset(
+        _strip_ver(r) for p in db.pkgcache for r in p.replaces),
+    )
+    changed = True
+
+  if changed:
+    safe_overwrite(str(OFFICIAL_INDEX), pickle.dumps(index), mode='wb')
+
+def init_data(dbpath: os.PathLike) -> None:
+  index = _load_index()
+  if not index:
+    _update_index(dbpath)
+    index = _load_index()
+
+  for repo in _official_repos:
+    r = index.get(repo)
+    if r is None:
+      continue
+    _official_packages.update(r.packages)
+    _official_groups.update(r.groups)
+    _official_replaces.update(r.replaces)
 
-def check_srcinfo() -> None:
-  srcinfo = get_srcinfo()
+def check_srcinfo(srcinfo: List[str]) -> None:
   bad_groups = []
   bad_packages = []
+  replaced = []
 
   for line in srcinfo:
     line = line.strip()
-    if line.startswith('group = '):
+    if line.startswith('groups = '):
       g = line.split()[-1]
       if g in _official_groups:
         bad_groups.append(g)
@@ -48,23 +136,77 @@ def check_srcinfo() -> None:
       pkg = line.split()[-1]
       if pkg in _official_packages:
         bad_packages.append(pkg)
+    elif line.startswith('pkgname = '):
+      pkg = line.split()[-1]
+      if pkg in _official_replaces:
+        replaced.append(pkg)
+
+  if bad_groups or bad_packages or replaced:
+    raise ConflictWithOfficialError(bad_groups, bad_packages, replaced)
+
+def _srcinfo_key(dir: Path) -> str:
+  '''hash of the PKGBUILD and the files it sources'''
+  with open(dir / 'PKGBUILD', 'rb') as f:
+    pkgbuild = f.read()
 
-  _G.pkgver, _G.pkgrel = _get_package_version(srcinfo)
+  m = hashlib.sha256(_SRCINFO_CACHE_VERSION)
+  m.update(b'%d:' % len(pkgbuild))
+  m.update(pkgbuild)
+  for name in _sourced_file_re.findall(pkgbuild.decode(errors='replace')):
+    try:
+      with open(dir / name, 'rb') as f:
+        data = f.read()
+    except OSError:
+      # not a file we can know about, e.g. /etc/makepkg.conf or $var
+      data = b''
+    m.update(name.encode() + b'\0%d:' % len(data))
+    m.update(data)
+  return m.hexdigest()
 
-  if bad_groups or bad_packages:
-    raise ConflictWithOfficialError(bad_groups, bad_packages)
+def get_srcinfo(dir: Optional[PathLike] = None) -> List[str]:
+  '''makepkg --printsrcinfo, cached by the content of the PKGBUILD
 
-def get_srcinfo() -> List[str]:
-  out = subprocess.check_output(
-    ['makepkg', '--printsrcinfo'],
-    universal_newlines = True,
-  )
+  The cache lives in ~/.lilac/srcinfo and is shared between runs and
+  worker processes.
+  '''
+  d = Path(dir or '.')
+  key = _srcinfo_key(d)
+  cachefile = SRCINFO_CACHE_DIR / key
+  try:
+    with open(cachefile) as f:
+      out = f.read()
+    os.utime(cachefile)
+  except FileNotFoundError:
+    out = subprocess.check_output(
+      ['makepkg', '--printsrcinfo'],
+      universal_newlines = True,
+      cwd = d,
+    )
+    SRCINFO_CACHE_DIR.mkdir(exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=SRCINFO_CACHE_DIR, prefix='.tmp')
+    with open(fd, 'w') as f:
+      f.write(out)
+    os.replace(tmpname, cachefile)
   return out.splitlines()
 
-def _get_package_version(srcinfo: List[str]) -> Tuple[str, str]:
+def prune_srcinfo_cache(max_age_days: int = 30) -> None:
+  '''remove cached .SRCINFO not used for ``max_age_days``'''
+  deadline = time.time() - max_age_days * 86400
+  try:
+    entries = list(os.scandir(SRCINFO_CACHE_DIR))
+  except FileNotFoundError:
+    return
+  for e in entries:
+    try:
+      if e.stat().st_mtime < deadline:
+        os.unlink(e.path)
+    except FileNotFoundError:
+      pass
+
+def get_package_version(srcinfo: List[str]) -> Tuple[str, str]:
   pkgver = pkgrel = None
 
-  for line in get_srcinfo():
+  for line in srcinfo:
     line = line.strip()
     if not pkgver and line.startswith('pkgver = '):
       pkgver = line.split()[-1]
@@ -0,0 +1,137 @@
+'''
+signing built packages and putting them into the repository directory
+'''
+
+import os
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from typing import List, Optional
+
+from .cmd import run_cmd
+from .const import PACKAGE_EXTS
+from .typing import Cmd
+
+logger = logging.getLogger(__name__)
+
+def package_files(pkgdir: Path) -> List[Path]:
+  '''package files a build has left in ``pkgdir``'''
+  return sorted(pkgdir / x for x in os.listdir(pkgdir)
+                if x.endswith(PACKAGE_EXTS))
+
+def sig_of(path: Path) -> Path:
+  return path.with_name(path.name + '.sig')
+
+def sign(path: Path) -> None:
+  '''sign ``path`` and check the signature'''
+  sig = sig_of(path)
+  try:
+    sig.unlink()
+  except FileNotFoundError:
+    pass
+  run_cmd(['gpg', '--pinentry-mode', 'loopback', '--passphrase', '',
+           '--detach-sign', '--', path.name], cwd=path.parent)
+  run_cmd(['gpg', '--verify', '--', sig.name, path.name],
+          cwd=path.parent, silent=True)
+
+class Publisher:
+  '''Sign built packages and put them into ``destdir``.
+
+  Package files are signed by up to ``jobs`` gpg processes at the same time,
+  all talking to the same gpg-agent. Each package is then published as a
+  whole: its files and signatures are linked into a staging directory and
+  renamed into ``destdir`` together, and checked to be the ones signed.
+  With ``dbname``, the repository database is updated with the new package
+  files only, and files of the versions they replace are removed.
+
+  Publishing happens in its own thread, one package at a time in the order
+  they're submitted, so builders don't wait for it.
+  '''
+
+  def __init__(
+    self, destdir: Path, jobs: int = 4, dbname: Optional[str] = None,
+  ) -> None:
+    self.destdir = destdir
+    self.dbname = dbname
+    self._signer = ThreadPoolExecutor(
+      max_workers=jobs, thread_name_prefix='sign')
+    self._publisher = ThreadPoolExecutor(
+      max_workers=1, thread_name_prefix='publish')
+    self._agent_started = False
+    self._lock = threading.Lock()
+
+  def submit(self, pkgdir: Path, files: List[Path]) -> Future:
+    '''sign ``files`` and publish them with source tarballs in ``pkgdir``
+
+    The returned future completes once they are in ``destdir``.
+    '''
+    self._start_agent()
+    signing = [self._signer.submit(sign, f) for f in files]
+    return self._publisher.submit(self._publish, pkgdir, files, signing)
+
+  def shutdown(self) -> None:
+    self._publisher.shutdown()
+    self._signer.shutdown()
+
+  def _start_agent(self) -> None:
+    # started once so that concurrent gpg processes don't race to start it
+    with self._lock:
+      if self._agent_started:
+        return
+      try:
+        run_cmd(['gpgconf', '--launch', 'gpg-agent'], silent=True)
+      except Exception:
+        logger.warning('failed to start gpg-agent', exc_info=True)
+      self._agent_started = True
+
+  def _publish(
+    self, pkgdir: Path, files: List[Path], signing: List[Future],
+  ) -> None:
+    for fu in signing:
+      fu.result()
+
+    batch: List[Path] = []
+    for f in files:
+      batch.extend((f, sig_of(f)))
+    batch.extend(pkgdir / x for x in os.listdir(pkgdir)
+                 if x.endswith('.src.tar.gz'))
+    self._link_all(batch)
+    if self.dbname:
+      self._update_db(files)
+    logger.info('published %s', ', '.join(f.name for f in files))
+
+  def _link_all(self, batch: List[Path]) -> None:
+    staging = Path(tempfile.mkdtemp(prefix='.staging-', dir=self.destdir))
+    try:
+      for f in batch:
+        os.link(f, staging / f.name)
+      for f in batch:
+        os.replace(staging / f.name, self.destdir / f.name)
+
+      for f in batch:
+        bad = _not_same_file(f, self.destdir / f.name)
+        if bad is not None:
+          raise RuntimeError(f'{f.name} in {self.destdir} {bad}')
+    finally:
+      for f in staging.iterdir():
+        f.unlink()
+      staging.rmdir()
+
+  def _update_db(self, files: List[Path]) -> None:
+    # repo-add reads only the given packages; --remove deletes the files
+    # and signatures of the entries they replace
+    db = self.destdir / f'{self.dbname}.db.tar.gz'
+    cmd: Cmd = ['repo-add', '--remove', '--quiet', db]
+    cmd.extend(self.destdir / f.name for f in files)
+    run_cmd(cmd)
+
+def _not_same_file(src: Path, dst: Path) -> Optional[str]:
+  try:
+    st = dst.stat()
+  except FileNotFoundError:
+    return 'is missing'
+  if not os.path.samestat(st, src.stat()):
+    return 'is not the built file'
+  return None
@@ -1,18 +1,104 @@
+import pickle
 import subprocess
+import threading
 from pathlib import Path
 from typing import Optional, Tuple, List, Union, Dict
 import logging
-from functools import lru_cache
 
 from github import GitHub
+from myutils import safe_overwrite
 
 from .mail import MailService
-from .typing import LilacMod, Maintainer
+from .ghusers import GitHubUsers, RateLimited
+from .typing import LilacInfo, LilacInfos, Maintainer
 from .tools import ansi_escape_re
+from .const import mydir
 from . import api
+from . import logstore
 
 logger = logging.getLogger(__name__)
 
+class GitAuthorIndex:
+  '''The last author other than lilac of each top-level path in the repo.
+
+  It's built with one ``git log --name-only`` walk and saved with the
+  commit it's built for, so later updates only walk the new commits.
+  '''
+
+  def __init__(self, repodir: Path, myaddress: str, file: Path) -> None:
+    self.repodir = repodir
+    self.myaddress = myaddress
+    self.file = file
+    self._authors: Optional[Dict[str, str]] = None
+    self._lock = threading.Lock()
+
+  def _git(self, *args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+      ['git'] + list(args), cwd = self.repodir,
+      stdout = subprocess.PIPE, stderr = subprocess.DEVNULL,
+      universal_newlines = True,
+    )
+
+  def _walk(self, revs: str) -> Dict[str, str]:
+    authors: Dict[str, str] = {}
+    cmd = [
+      'git', '-c', 'core.quotepath=off', 'log',
+      '--format=%x00%an <%ae>', '--name-only', revs,
+    ]
+    with subprocess.Popen(
+      cmd, cwd = self.repodir, stdout = subprocess.PIPE,
+      universal_newlines = True, errors = 'replace',
+    ) as p:
+      assert p.stdout is not None
+      author = None
+      for l in p.stdout:
+        l = l.rstrip('\n')
+        if l.startswith('\0'):
+          author = l[1:]
+          if self.myaddress in author:
+            author = None
+        elif l and author:
+          # newest first
+          authors.setdefault(l.split('/', 1)[0], author)
+    if p.returncode != 0:
+      raise subprocess.CalledProcessError(p.returncode, cmd)
+    return authors
+
+  def update(self, save: bool = True) -> None:
+    '''bring the index up to date with HEAD, saving it if ``save``'''
+    head = self._git('rev-parse', 'HEAD').stdout.strip()
+    try:
+      with open(self.file, 'rb') as f:
+        last, authors = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError, ValueError):
+      last, authors = None, {}
+
+    if last == head:
+      self._authors = authors
+      return
+
+    if last is not None and self._git(
+      'merge-base', '--is-ancestor', last, head).returncode == 0:
+      authors.update(self._walk(f'{last}..{head}'))
+    else:
+      # history has been rewritten
+      authors = self._walk(head)
+
+    self._authors = authors
+    if save:
+      safe_overwrite(
+        str(self.file), pickle.dumps((head, authors)), mode='wb')
+
+  def get(self, path: str) -> Optional[Maintainer]:
+    with self._lock:
+      if self._authors is None:
+        self.update(save=False)
+      assert self._authors is not None
+      author = self._authors.get(path.split('/', 1)[0])
+    if author is None:
+      return None
+    return Maintainer.from_email_address(author)
+
 class Repo:
   def __init__(self, config):
     self.myaddress = config.get('lilac', 'email')
@@ -22,27 +108,49 @@ class Repo:
       'smtp', 'use_ansi', fallback=False)
 
     self.repodir = Path(config.get('repository', 'repodir')).expanduser()
+    self.git_authors = GitAuthorIndex(
+      self.repodir, self.myaddress, mydir / 'git-authors.pickle')
+    self._maintainers: Dict[str, List[Maintainer]] = {}
 
     self.ms = MailService(config)
     github_token = config.get('lilac', 'github_token', fallback=None)
     if github_token:
       self.gh = GitHub(config.get('lilac', 'github_token', fallback=None))
+      self.github_users: Optional[GitHubUsers] = GitHubUsers(
+        self.gh, mydir / 'github-users.json')
     else:
       self.gh = None
+      self.github_users = None
 
-  @lru_cache()
   def maintainer_from_github(self, username: str) -> Optional[Maintainer]:
-    if self.gh is None:
+    if self.github_users is None:
       raise ValueError('未设置 github token，无法从 GitHub 取得用户 Email')
 
-    userinfo = self.gh.get_user_info(username)
-    if userinfo['email']:
-      return Maintainer(userinfo['name'], userinfo['email'], username)
+    name, email = self.github_users.get(username)
+    if email:
+      return Maintainer(name or username, email, username)
     else:
       return None
 
-  @lru_cache()
-  def find_maintainers(self, mod: LilacMod) -> List[Maintainer]:
+  def prefetch_github_maintainers(self, mods: LilacInfos) -> None:
+    '''look up GitHub users in maintainers of ``mods`` all at once'''
+    if self.github_users is None:
+      return
+    names = {
+      m['github']
+      for mod in mods.values()
+      for m in getattr(mod, 'maintainers', None) or ()
+      if 'github' in m and 'email' not in m
+    }
+    self.github_users.prefetch(names)
+
+  def find_maintainers(self, mod: LilacInfo) -> List[Maintainer]:
+    # errors are mailed only once
+    if mod.pkgbase not in self._maintainers:
+      self._maintainers[mod.pkgbase] = self._find_maintainers(mod)
+    return self._maintainers[mod.pkgbase]
+
+  def _find_maintainers(self, mod: LilacInfo) -> List[Maintainer]:
     ret = []
     errors = []
 
@@ -56,6 +164,10 @@ class Repo:
         elif 'github' in m:
           try:
             u = self.maintainer_from_github(m['github'])
+          except RateLimited as e:
+            # not the maintainers' fault; try again in a later run
+            logger.warning('%s: %s; skipping GitHub user %s',
+                           mod.pkgbase, e, m['github'])
           except Exception as e:
             errors.append(f'从 GitHub 获取用户 Email 时出错：{e!r}')
           else:
@@ -70,8 +182,7 @@ class Repo:
 
     if not ret or errors:
       # fallback to git
-      dir = self.repodir / mod.pkgbase
-      git_maintainer = self.find_maintainer_by_git(dir)
+      git_maintainer = self.find_maintainer_by_git(mod.pkgbase)
 
     if errors:
       error_str = '\n'.join(errors)
@@ -88,47 +199,36 @@ class Repo:
     else:
       return ret
 
-  def find_maintainer_by_git(
-    self,
-    dir: Path = Path('.'),
-    file: str = '*',
-  ) -> Maintainer:
-
-    me = self.myaddress
-
-    cmd = [
-      "git", "log", "--format=%H %an <%ae>", "--", file,
-    ]
-    p = subprocess.Popen(
-      cmd, stdout=subprocess.PIPE, universal_newlines=True,
-      cwd = dir,
-    )
-
-    try:
-      while True:
-        line = p.stdout.readline()
-        commit, author = line.rstrip().split(None, 1)
-        if me not in author:
-          return Maintainer.from_email_address(author)
-    finally:
-      p.terminate()
+  def find_maintainer_by_git(self, path: str) -> Maintainer:
+    '''the last one other than lilac who changed ``path`` in the repo'''
+    m = self.git_authors.get(path)
+    if m is None:
+      logger.warning('no one has changed %s, fallback to master.', path)
+      return Maintainer.from_email_address(self.mymaster)
+    return m
 
   def report_error(self, subject: str, msg: str) -> None:
     self.ms.sendmail(self.mymaster, subject, msg)
 
   def send_error_report(
     self,
-    mod: Union[LilacMod, str], *,
+    mod: Union[LilacInfo, str], *,
     msg: Optional[str] = None,
     exc: Optional[Tuple[Exception, str]] = None,
     subject: Optional[str] = None,
     build_output: Optional[str] = None,
+    build_log: Optional[Path] = None,
   ) -> None:
+    '''mail an error to the maintainers of ``mod``
+
+    With ``build_log`` from :mod:`.logstore`, an excerpt of it is included
+    instead of the whole output of a failed command.
+    '''
     if msg is None and exc is None:
       raise TypeError('send_error_report received inefficient args')
 
     if isinstance(mod, str):
-      maintainers = [self.find_maintainer_by_git(file=mod)]
+      maintainers = [self.find_maintainer_by_git(mod)]
       pkgbase = mod
     else:
       maintainers = self.find_maintainers(mod)
@@ -142,9 +242,13 @@ class Repo:
       exception, tb = exc
       if isinstance(exception, subprocess.CalledProcessError):
         subject_real = subject or '在编译软件包 %s 时发生错误'
+        output = exception.output
+        if build_log is not None and output \
+           and len(output) > logstore.EXCERPT_SIZE:
+          output = '……\n' + output[-logstore.EXCERPT_SIZE:]
         msgs.append('命令执行失败！\n\n命令 %r 返回了错误号 %d。' \
                     '命令的输出如下：\n\n%s' % (
-                      exception.cmd, exception.returncode, exception.output))
+                      exception.cmd, exception.returncode, output))
         msgs.append('调用栈如下：\n\n' + tb)
       elif isinstance(exception, api.AurDownloadError):
         subject_real = subject or '在获取AUR包 %s 时发生错误'
@@ -164,6 +268,14 @@ class Repo:
     if build_output:
       msgs.append('编译命令输出如下：\n\n' + build_output)
 
+    if build_log is not None:
+      try:
+        excerpt = logstore.excerpt(build_log)
+      except Exception:
+        logger.exception('failed to get excerpt of %s', build_log)
+        excerpt = ''
+      msgs.append(f'完整日志位于 {build_log}，摘录如下：\n\n{excerpt}')
+
     msg = '\n'.join(msgs)
     if self.trim_ansi_codes:
       msg = ansi_escape_re.sub('', msg)
@@ -0,0 +1,125 @@
+'''
+downloaded sources shared between packages and runs
+
+Files are kept in ~/.lilac/sources under a key made of their URL and their
+checksum in the PKGBUILD, so a file is only reused where the PKGBUILD asks
+for exactly that content. They are linked into package directories before
+builds, where makepkg (and makechrootpkg, which uses the package directory
+as SRCDEST) finds them instead of downloading again.
+'''
+
+import os
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from typing import List, Iterator, Tuple, Dict
+
+from .const import mydir
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = mydir / 'sources'
+# checksum arrays in the order they are preferred
+_ALGOS = ('sha256', 'sha512', 'b2', 'sha384', 'sha224', 'sha1', 'md5')
+_PROTOCOLS = ('http', 'https', 'ftp')
+
+def _sources(srcinfo: List[str]) -> Iterator[Tuple[str, str, str, str]]:
+  '''(filename, url, algo, checksum) of downloaded sources'''
+  values: Dict[str, List[str]] = {}
+  for line in srcinfo:
+    if not line.startswith('\t'):
+      if values:
+        # only pkgbase has sources
+        break
+      continue
+    key, _, value = line.strip().partition(' = ')
+    values.setdefault(key, []).append(value)
+
+  for key, sources in values.items():
+    if key != 'source' and not key.startswith('source_'):
+      continue
+    suffix = key[len('source'):]
+    for algo in _ALGOS:
+      sums = values.get(f'{algo}sums{suffix}')
+      if sums and len(sums) == len(sources):
+        break
+    else:
+      continue
+
+    for source, sum in zip(sources, sums):
+      if sum == 'SKIP':
+        continue
+      name, sep, url = source.partition('::')
+      if not sep:
+        url = source
+        name = url.rsplit('/', 1)[-1]
+      if url.split('://', 1)[0] not in _PROTOCOLS:
+        continue
+      yield name, url, algo, sum
+
+def _key(url: str, algo: str, sum: str) -> str:
+  return hashlib.sha256(f'{url}\n{algo}:{sum}'.encode()).hexdigest()
+
+def _checksum(file: Path, algo: str) -> str:
+  h = hashlib.blake2b() if algo == 'b2' else hashlib.new(algo)
+  with open(file, 'rb') as f:
+    while True:
+      data = f.read(1024 ** 2)
+      if not data:
+        break
+      h.update(data)
+  return h.hexdigest()
+
+def _link(src: Path, dst: Path) -> None:
+  tmp = dst.with_name(f'.{dst.name}.tmp')
+  try:
+    os.link(src, tmp)
+  except OSError:
+    # another filesystem or a leftover tmp file
+    shutil.copy2(src, tmp)
+  os.replace(tmp, dst)
+
+def sync(
+  dir: Path, srcinfo: List[str], cachedir: Path = CACHE_DIR,
+) -> None:
+  '''link cached sources into ``dir`` and cache new ones found there
+
+  Files are only added to the cache after their checksums are verified.
+  '''
+  cachedir.mkdir(parents=True, exist_ok=True)
+  for name, url, algo, sum in _sources(srcinfo):
+    cached = cachedir / _key(url, algo, sum)
+    file = dir / name
+    try:
+      if cached.exists():
+        if not file.exists():
+          logger.info('using cached %s', url)
+          _link(cached, file)
+        # for LRU eviction
+        os.utime(cached)
+      elif file.exists():
+        if _checksum(file, algo) == sum:
+          _link(file, cached)
+    except OSError:
+      logger.warning('failed to share %s through the cache',
+                     name, exc_info=True)
+
+def prune(max_size: int, cachedir: Path = CACHE_DIR) -> None:
+  '''remove least recently used sources until they take ``max_size`` bytes'''
+  try:
+    entries = [(e.stat().st_mtime, e.stat().st_size, e.path)
+               for e in os.scandir(cachedir) if e.name[0] != '.']
+  except FileNotFoundError:
+    return
+
+  total = sum(x[1] for x in entries)
+  entries.sort()
+  for _, size, path in entries:
+    if total <= max_size:
+      break
+    try:
+      os.unlink(path)
+    except FileNotFoundError:
+      pass
+    total -= size
@@ -2,8 +2,11 @@ import os
 import re
 import subprocess
 import signal
+import configparser
+from pathlib import Path
 
 ansi_escape_re = re.compile(r'\x1B(\[[0-?]*[ -/]*[@-~]|\(B)')
+topdir = Path(__file__).resolve().parents[1]
 
 def kill_child_processes() -> None:
   pids = subprocess.check_output(
@@ -14,3 +17,9 @@ def kill_child_processes() -> None:
       os.kill(int(pid), signal.SIGKILL)
     except OSError:
       pass
+
+def read_config() -> configparser.ConfigParser:
+  config = configparser.ConfigParser()
+  config.optionxform = lambda option: option # type: ignore
+  config.read(topdir / 'config.ini')
+  return config
@@ -1,5 +1,7 @@
 import types
-from typing import Union, Dict, Tuple, Type, List, NamedTuple, Optional
+from typing import (
+  Union, Dict, Tuple, Type, List, NamedTuple, Optional, Any, Sequence,
+)
 from pathlib import Path
 
 class LilacMod(types.ModuleType):
@@ -10,6 +12,34 @@ class LilacMod(types.ModuleType):
 
 LilacMods = Dict[str, LilacMod]
 
+class LilacInfo:
+  '''fields of a lilac.py / lilac.yaml needed before building it
+
+  Defaults are the same as those lilac assumes for a module missing them.
+  '''
+  def __init__(
+    self,
+    pkgbase: str,
+    update_on: Optional[List[Dict[str, Any]]] = None,
+    depends: Sequence[Union[str, Tuple[str, str]]] = (),
+    maintainers: Optional[List[Dict[str, str]]] = None,
+    time_limit_hours: float = 1,
+    build_prefix: str = 'extra-x86_64',
+    check_interval: Optional[float] = None,
+  ) -> None:
+    self.pkgbase = pkgbase
+    self.update_on = update_on
+    self.depends = depends
+    self.maintainers = maintainers
+    self.time_limit_hours = time_limit_hours
+    self.build_prefix = build_prefix
+    self.check_interval = check_interval
+
+  def __repr__(self) -> str:
+    return f'<LilacInfo {self.pkgbase}>'
+
+LilacInfos = Dict[str, LilacInfo]
+
 ExcInfo = Tuple[Type[BaseException], BaseException, types.TracebackType]
 
 Cmd = List[Union[str, Path]]
@@ -0,0 +1,164 @@
+'''
+bare mirrors of git and Mercurial sources under ~/.lilac/vcs
+
+Mirrors are fetched once at the start of a run, all at the same time.
+Before makepkg runs, the VCS sources of a package are cloned from (or
+fetched from) the mirrors into the package directory, where makepkg looks
+for them first; its own fetch from upstream then only gets what's newer.
+
+Subversion sources aren't mirrored: makepkg keeps working copies of them,
+which can't be checked out from a mirror and then pointed at upstream.
+'''
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Iterator, Tuple
+
+from .cmd import run_cmd
+from .const import mydir
+from .typing import Cmd
+
+logger = logging.getLogger(__name__)
+
+VCS_DIR = mydir / 'vcs'
+
+# url prefixes of sources of each VCS
+_PREFIXES = {
+  'git': ('git+', 'git://'),
+  'hg': ('hg+',),
+}
+
+def _vcs_sources(srcinfo: List[str]) -> Iterator[Tuple[str, str, str]]:
+  '''(VCS, directory name used by makepkg, url) of git and hg sources'''
+  for line in srcinfo:
+    line = line.strip()
+    if not line.startswith('source'):
+      continue
+    key, _, source = line.partition(' = ')
+    if key != 'source' and not key.startswith('source_'):
+      continue
+
+    name, sep, url = source.partition('::')
+    if not sep:
+      url = source
+    for vcs, prefixes in _PREFIXES.items():
+      if url.startswith(prefixes):
+        break
+    else:
+      continue
+
+    url = url.split('#', 1)[0].split('?', 1)[0]
+    if url.startswith(f'{vcs}+'):
+      url = url[len(vcs)+1:]
+    if not sep:
+      name = url.rstrip('/').rsplit('/', 1)[-1]
+      if vcs == 'git' and name.endswith('.git'):
+        name = name[:-len('.git')]
+    yield vcs, name, url
+
+def _mirror_path(name: str, url: str, vcsdir: Path) -> Path:
+  h = hashlib.sha256(url.encode()).hexdigest()[:12]
+  return vcsdir / f'{name}-{h}'
+
+def _clone_cmd(vcs: str, src: str, dst: Path) -> Cmd:
+  '''clone ``src`` into ``dst`` without a working tree'''
+  if vcs == 'hg':
+    return ['hg', 'clone', '--noupdate', '--quiet', src, str(dst)]
+  else:
+    return ['git', 'clone', '--mirror', '--quiet', src, str(dst)]
+
+def _create_mirror(vcs: str, url: str, mirror: Path) -> None:
+  logger.info('mirroring %s', url)
+  mirror.parent.mkdir(parents=True, exist_ok=True)
+  tmp = Path(tempfile.mkdtemp(prefix='.tmp', dir=mirror.parent))
+  try:
+    run_cmd(_clone_cmd(vcs, url, tmp))
+    try:
+      os.rename(tmp, mirror)
+    except OSError:
+      # made by another build meanwhile
+      pass
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+def _use_mirror(vcs: str, mirror: Path, dst: Path, url: str) -> None:
+  if vcs == 'hg':
+    if dst.is_dir():
+      run_cmd(['hg', '-R', str(dst), 'pull', '--quiet', str(mirror)],
+              silent=True)
+    else:
+      # local clones are hard-linked too
+      run_cmd(_clone_cmd(vcs, str(mirror), dst), silent=True)
+      # where makepkg's hg pull goes
+      with open(dst / '.hg' / 'hgrc', 'w') as f:
+        f.write(f'[paths]\ndefault = {url}\n')
+  elif dst.is_dir():
+    run_cmd(['git', '-C', str(dst), 'fetch', '--quiet', '--prune',
+             str(mirror), '+refs/*:refs/*'], silent=True)
+  else:
+    # objects are hard-linked on the same filesystem
+    run_cmd(_clone_cmd(vcs, str(mirror), dst), silent=True)
+    # makepkg checks that it's a clone of the url
+    run_cmd(['git', '-C', str(dst), 'remote', 'set-url', 'origin', url],
+            silent=True)
+
+def use_mirrors(
+  dir: Path, srcinfo: List[str], vcsdir: Path = VCS_DIR,
+) -> None:
+  '''bring VCS sources in ``dir`` up to date with the mirrors'''
+  for vcs, name, url in _vcs_sources(srcinfo):
+    mirror = _mirror_path(name, url, vcsdir)
+    try:
+      if not mirror.exists():
+        _create_mirror(vcs, url, mirror)
+      # mirrors not used for long are removed
+      os.utime(mirror)
+      _use_mirror(vcs, mirror, dir / name, url)
+    except Exception:
+      logger.warning('failed to use the mirror of %s; makepkg will fetch it',
+                     url, exc_info=True)
+
+def update_mirrors(
+  max_workers: int = 8, max_age_days: int = 30, vcsdir: Path = VCS_DIR,
+) -> None:
+  '''fetch all mirrors, removing those not used for ``max_age_days``'''
+  try:
+    mirrors = [Path(e.path) for e in os.scandir(vcsdir)
+               if e.is_dir() and not e.name.startswith('.')]
+  except FileNotFoundError:
+    return
+
+  deadline = time.time() - max_age_days * 86400
+  to_update = []
+  for m in mirrors:
+    if m.stat().st_mtime < deadline:
+      logger.info('removing unused mirror %s', m)
+      shutil.rmtree(m, ignore_errors=True)
+    else:
+      to_update.append(m)
+
+  def update(m: Path) -> None:
+    mtime = m.stat().st_mtime
+    cmd: Cmd
+    if (m / '.hg').is_dir():
+      cmd = ['hg', '-R', str(m), 'pull', '--quiet']
+    else:
+      cmd = ['git', '-C', str(m), 'remote', 'update', '--prune']
+    try:
+      run_cmd(cmd, silent=True)
+    except Exception as e:
+      logger.warning('failed to update mirror %s: %r', m, e)
+    # fetching doesn't count as use
+    os.utime(m, (mtime, mtime))
+
+  logger.info('updating %d VCS mirrors', len(to_update))
+  start = time.time()
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    list(executor.map(update, to_update))
+  logger.info('VCS mirrors updated in %.1fs', time.time() - start)
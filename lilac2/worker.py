@@ -0,0 +1,98 @@
+'''
+build one package in its own process
+
+The parent (the ``lilac`` script) starts ``python -m lilac2.worker pkgbase``
+with the package directory as cwd, feeds a JSON object on stdin and reads
+the result back from the file named by its ``result`` key.
+'''
+
+import sys
+import json
+import logging
+import traceback
+from pathlib import Path
+from typing import Dict, Any
+
+from myutils import execution_timeout
+from nicelogger import enable_pretty_logging
+
+from lilaclib import lilac_build, MissingDependencies
+
+from . import lilacpy
+from . import pkgbuild
+from .building import serialize_error
+from .chroot import Chroot
+from .const import _G
+from .packages import Dependency, BuiltPackages
+from .repo import Repo
+from .tools import kill_child_processes, read_config
+
+logger = logging.getLogger(__name__)
+
+def build(input: Dict[str, Any]) -> Dict[str, Any]:
+  # dependencies are resolved by the main process
+  built = BuiltPackages()
+  depends = []
+  for d, name, path in input['depends']:
+    depends.append(Dependency(Path(d), name, built))
+    if path:
+      built.add(Path(d), Path(path))
+  chroot = None
+  if input['chroot']:
+    dir, copy, clean, localrepo_db = input['chroot']
+    chroot = Chroot(
+      Path(dir), copy, clean, Path(localrepo_db) if localrepo_db else None)
+  r: Dict[str, Any] = {'version': None}
+
+  try:
+    pkgbuild.init_data(input['dbpath'])
+    with lilacpy.load_lilac(Path('.')) as mod:
+      time_limit_hours = getattr(mod, 'time_limit_hours', 1)
+      try:
+        with execution_timeout(time_limit_hours * 3600):
+          lilac_build(
+            mod,
+            oldver = input['oldver'], newver = input['newver'],
+            depends = depends,
+            bindmounts = input['bindmounts'],
+            chroot = chroot,
+          )
+      except TimeoutError:
+        kill_child_processes()
+        raise
+      finally:
+        G = getattr(mod, '_G', None)
+        if G is not None and getattr(G, 'pkgver', None):
+          r['version'] = [G.pkgver, G.pkgrel]
+    r['status'] = 'done'
+  except MissingDependencies as e:
+    r['status'] = 'missing_deps'
+    r['deps'] = sorted(e.deps)
+  except pkgbuild.ConflictWithOfficialError as e:
+    r['status'] = 'conflict'
+    r['groups'] = e.groups
+    r['packages'] = e.packages
+    r['replaced'] = e.replaced
+  except Exception as e:
+    logger.exception('packaging error')
+    r['status'] = 'failed'
+    r['error'] = serialize_error(e)
+    r['traceback'] = traceback.format_exc()
+
+  return r
+
+def main() -> None:
+  enable_pretty_logging('DEBUG')
+  input = json.load(sys.stdin)
+  # for update_aur_repo to send reports
+  _G.repo = Repo(read_config())
+
+  try:
+    r = build(input)
+    with open(input['result'], 'w') as f:
+      json.dump(r, f)
+  finally:
+    _G.repo.ms.flush()
+
+if __name__ == '__main__':
+  main()
@@ -1,5 +1,5 @@
-from subprocess import CalledProcessError
 import os
+import sys
 import logging
 from types import SimpleNamespace
 from io import BytesIO
@@ -24,15 +24,16 @@ from lilac2.api import (
   update_pkgver_and_pkgrel,
   update_pkgrel,
   pypi_pre_build, pypi_post_build,
-  git_add_files, git_commit,
+  git_add_files, git_commit, git_index_lock,
   git_pkgbuild_commit,
   AurDownloadError,
   update_aur_repo,
 )
-from lilac2.const import SPECIAL_FILES
+from lilac2.const import SPECIAL_FILES, PACKAGE_EXTS
+from lilac2.chroot import Chroot
 from lilac2.typing import LilacMod
-from lilac2 import pkgbuild
-from lilac2.packages import Dependency
+from lilac2 import pkgbuild, srccache, vcs
+from lilac2.packages import Dependency, get_changes
 git_push, add_into_array, add_depends, add_makedepends
 git_pull, git_reset_hard
 edit_file, update_pkgver_and_pkgrel
@@ -47,7 +48,6 @@ s.headers['User-Agent'] = UserAgent
 logger = logging.getLogger(__name__)
 EMPTY_COMMIT = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
 _g = SimpleNamespace()
-build_output = None
 PYPI_URL = 'https://pypi.python.org/pypi/%s/json'
 
 class MissingDependencies(Exception):
@@ -112,9 +112,7 @@ def get_pypi_info(name):
   return s.get(PYPI_URL % name).json()
 
 def pkgrel_changed(revisions, pkgname):
-  cmd = ["git", "diff", "-p", revisions, '--', pkgname + '/PKGBUILD']
-  r = run_cmd(cmd, silent=True).splitlines()
-  return any(x.startswith('+pkgrel=') for x in r)
+  return pkgname in get_changes(revisions).pkgrel_bumped
 
 def clean_directory():
   '''clean all PKGBUILD and related files'''
@@ -134,7 +132,8 @@ def clean_directory():
 
 def git_rm_files(files):
   if files:
-    run_cmd(['git', 'rm', '--cached', '--'] + files)
+    with git_index_lock():
+      run_cmd(['git', 'rm', '--cached', '--'] + files)
 
 def git_last_commit(ref=None):
   cmd = ['git', 'log', '-1', '--format=%H']
@@ -166,11 +165,12 @@ def aur_pre_build(name=None, *, do_vcs_update=True):
       update_pkgrel(max(pkgrel, new_pkgrel))
 
 def aur_post_build():
-  git_rm_files(_g.aur_pre_files)
-  git_add_files(_g.aur_building_files, force=True)
-  output = run_cmd(["git", "status", "-s", "."]).strip()
-  if output:
-    git_commit()
+  with git_index_lock():
+    git_rm_files(_g.aur_pre_files)
+    git_add_files(_g.aur_building_files, force=True)
+    output = run_cmd(["git", "status", "-s", "."]).strip()
+    if output:
+      git_commit()
   del _g.aur_pre_files, _g.aur_building_files
 
 def lilac_build(mod: LilacMod, build_prefix: Optional[str] = None,
@@ -178,14 +178,12 @@ def lilac_build(mod: LilacMod, build_prefix: Optional[str] = None,
                 accept_noupdate: bool = False,
                 depends: Iterable[Dependency] = (),
                 bindmounts: Iterable[str] = (),
+                chroot: Optional[Chroot] = None,
                ) -> None:
-  run_cmd(["sh", "-c", "rm -f -- *.pkg.tar.xz *.pkg.tar.xz.sig *.src.tar.gz"])
+  patterns = ' '.join(f'*{ext} *{ext}.sig' for ext in PACKAGE_EXTS)
+  run_cmd(["sh", "-c", f"rm -f -- {patterns} *.src.tar.gz"])
   success = False
 
-  global build_output
-  # reset in case no one cleans it up
-  build_output = None
-
   try:
     if not hasattr(mod, '_G'):
       # fill nvchecker result unless already filled (e.g. by hand)
@@ -194,7 +192,11 @@ def lilac_build(mod: LilacMod, build_prefix: Optional[str] = None,
     if pre_build is not None:
       logger.debug('accept_noupdate=%r, oldver=%r, newver=%r', accept_noupdate, oldver, newver)
       pre_build()
-    pkgbuild.check_srcinfo()
+    srcinfo = pkgbuild.get_srcinfo()
+    mod._G.pkgver, mod._G.pkgrel = pkgbuild.get_package_version(srcinfo)
+    pkgbuild.check_srcinfo(srcinfo)
+    srccache.sync(Path('.'), srcinfo)
+    vcs.use_mirrors(Path('.'), srcinfo)
     recv_gpg_keys()
 
     need_build_first = set()
@@ -220,8 +222,11 @@ def lilac_build(mod: LilacMod, build_prefix: Optional[str] = None,
     if hasattr(mod, 'makechrootpkg_args'):
         makechrootpkg_args = mod.makechrootpkg_args
 
-    call_build_cmd(build_prefix, depend_packages, bindmounts, makechrootpkg_args)
-    pkgs = [x for x in os.listdir() if x.endswith('.pkg.tar.xz')]
+    call_build_cmd(build_prefix, depend_packages, bindmounts,
+                   makechrootpkg_args, chroot)
+    # keep what the build has downloaded
+    srccache.sync(Path('.'), srcinfo)
+    pkgs = [x for x in os.listdir() if x.endswith(PACKAGE_EXTS)]
     if not pkgs:
       raise Exception('no package built')
     post_build = getattr(mod, 'post_build', None)
@@ -233,12 +238,16 @@ def lilac_build(mod: LilacMod, build_prefix: Optional[str] = None,
     if post_build_always is not None:
       post_build_always(success=success)
 
-def call_build_cmd(tag, depends, bindmounts=(), makechrootpkg_args=[]):
-  global build_output
+def call_build_cmd(tag, depends, bindmounts=(), makechrootpkg_args=[],
+                   chroot=None):
   if tag == 'makepkg':
     cmd = ['makepkg', '--holdver']
   else:
-    cmd = ['%s-build' % tag, '--']
+    if chroot is not None:
+      # a working copy of a chroot updated earlier in this run
+      cmd = chroot.makechrootpkg_cmd()
+    else:
+      cmd = ['%s-build' % tag, '--']
 
     if depends:
       for x in depends:
@@ -259,11 +268,17 @@ def call_build_cmd(tag, depends, bindmounts=(), makechrootpkg_args=[]):
     cmd.extend(['--', '--holdver'])
 
   # NOTE that Ctrl-C here may not succeed
-  try:
-    build_output = run_cmd(cmd, use_pty=True)
-  except CalledProcessError:
-    build_output = None
-    raise
+  # the full output is in the build log; keep only what error mails show
+  if sys.stderr.isatty():
+    run_cmd(cmd, use_pty=True, output_window=1024 ** 2)
+  else:
+    # stderr is the build log of a worker; store it without progress lines
+    sys.stderr.flush()
+    try:
+      run_cmd(cmd, use_pty=True, silent=True, logfile=sys.stderr.buffer,
+              output_window=1024 ** 2)
+    finally:
+      sys.stderr.buffer.flush()
 
 def single_main(build_prefix='makepkg'):
   prepend_self_path()
@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+@pytest.fixture
+def stub_command(tmp_path, monkeypatch):
+  '''``stub_command(name, script)`` puts a command first in PATH'''
+  bindir = tmp_path / 'bin'
+  bindir.mkdir()
+  monkeypatch.setenv('PATH', f'{bindir}:{os.environ["PATH"]}')
+
+  def stub(name, script):
+    p = bindir / name
+    p.write_text(script)
+    p.chmod(0o755)
+  return stub
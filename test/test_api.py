@@ -0,0 +1,57 @@
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2 import const
+from lilac2.api import git_add_files, git_commit, git_index_lock
+
+from myutils import at_dir
+
+def git(*args):
+  return subprocess.check_output(
+    ['git', *args], universal_newlines=True).rstrip('\n')
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+  monkeypatch.setattr(const, 'mydir', tmp_path)
+  for k, v in [('NAME', 't'), ('EMAIL', 't@example.com')]:
+    monkeypatch.setenv(f'GIT_AUTHOR_{k}', v)
+    monkeypatch.setenv(f'GIT_COMMITTER_{k}', v)
+  repodir = tmp_path / 'repo'
+  (repodir / 'foo').mkdir(parents=True)
+  (repodir / 'foo' / 'PKGBUILD').write_text('pkgrel=1\n')
+  (repodir / 'foo' / 'old').write_text('old\n')
+  (repodir / 'bar').mkdir()
+  (repodir / 'bar' / 'PKGBUILD').write_text('pkgrel=1\n')
+  with at_dir(repodir):
+    git('init', '-q')
+    git('add', '.')
+    git('commit', '-q', '-m', 'init')
+  return repodir
+
+def test_add_and_commit(repo):
+  with at_dir(repo / 'foo'):
+    (repo / 'foo' / 'PKGBUILD').write_text('pkgrel=2\n')
+    # not staged, so not committed
+    (repo / 'bar' / 'PKGBUILD').write_text('pkgrel=2\n')
+    with git_index_lock():
+      git('rm', '-q', '--cached', 'old')
+      git_add_files('PKGBUILD')
+      git_commit()
+
+    assert set(git('show', '--name-status', '--format=').splitlines()) == {
+      'D\tfoo/old', 'M\tfoo/PKGBUILD'}
+    assert git('status', '--porcelain').splitlines() == [
+      ' M bar/PKGBUILD', '?? foo/old']
+
+def test_add_failure(repo):
+  with at_dir(repo / 'foo'):
+    with pytest.raises(subprocess.CalledProcessError):
+      git_add_files(['PKGBUILD', 'missing'])
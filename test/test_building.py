@@ -0,0 +1,117 @@
+import pathlib
+import sys
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2.building import (
+  BuildSorter, BuildHistory, estimate_run_time, load_history_from_log,
+)
+
+def drain(sorter):
+  ret = []
+  while True:
+    p = sorter.pop_ready()
+    if p is None:
+      return ret
+    ret.append(p)
+
+def test_independent_packages_are_ready_together():
+  sorter = BuildSorter({}, ['a', 'b', 'c'])
+  assert drain(sorter) == ['a', 'b', 'c']
+
+def test_dependers_wait_for_dependencies():
+  depmap = {'app': {'lib', 'base'}, 'lib': {'base'}, 'other': set()}
+  sorter = BuildSorter(depmap, ['base', 'other', 'lib', 'app'])
+
+  assert drain(sorter) == ['base', 'other']
+  sorter.done('other')
+  assert drain(sorter) == []
+  sorter.done('base')
+  assert drain(sorter) == ['lib']
+  sorter.done('lib')
+  assert drain(sorter) == ['app']
+  assert sorter.is_active()
+  sorter.done('app')
+  assert not sorter.is_active()
+
+def test_dependencies_outside_the_run_are_ignored():
+  sorter = BuildSorter({'app': {'already-built', 'app'}}, ['app'])
+  assert drain(sorter) == ['app']
+
+def test_longest_critical_path_goes_first():
+  # slow-lib is needed by app, so it should start before the quick ones
+  depmap = {'app': {'slow-lib'}}
+  durations = {'quick1': 60, 'quick2': 60, 'slow-lib': 3600, 'app': 600}
+  sorter = BuildSorter(depmap, ['quick1', 'quick2', 'slow-lib', 'app'],
+                       durations)
+  assert sorter.priority['slow-lib'] == 4200
+  assert drain(sorter) == ['slow-lib', 'quick1', 'quick2']
+
+def test_add_while_running():
+  sorter = BuildSorter({}, ['lib'])
+  assert drain(sorter) == ['lib']
+  sorter.add('app', {'lib', 'not-building'})
+  sorter.add('other', set())
+  assert sorter.priority['lib'] == 2
+  assert drain(sorter) == ['other']
+  sorter.done('lib')
+  assert drain(sorter) == ['app']
+  sorter.done('other')
+  sorter.done('app')
+  assert not sorter.is_active()
+
+def test_add_one_at_a_time():
+  depmap = {'lib': {'base'}, 'app': {'lib', 'base'}, 'tool': {'base'},
+            'doc': {'app'}}
+  packages = ['base', 'lib', 'tool', 'app', 'doc']
+  durations = {'base': 10, 'lib': 100, 'tool': 300, 'app': 50, 'doc': 5}
+  sorter = BuildSorter({}, [])
+  for p in packages:
+    sorter.add(p, depmap.get(p, ()), durations[p])
+    expected = BuildSorter(depmap, packages[:packages.index(p)+1], durations)
+    assert sorter.priority == expected.priority
+  assert sorter.priority['base'] == 310
+
+  assert drain(sorter) == ['base']
+  sorter.done('base')
+  assert drain(sorter) == ['tool', 'lib']
+
+def test_long_chain():
+  # longer than the recursion limit
+  n = 2000
+  packages = [f'p{i}' for i in range(n)]
+  depmap = {packages[i]: {packages[i-1]} for i in range(1, n)}
+  assert BuildSorter(depmap, packages).priority['p0'] == n
+
+  sorter = BuildSorter({}, [])
+  for p in packages:
+    sorter.add(p, depmap.get(p, ()))
+  assert sorter.priority['p0'] == n
+
+def test_estimate_run_time():
+  depmap = {'app': {'lib'}}
+  durations = {'lib': 100, 'app': 50, 'other': 120}
+  packages = ['lib', 'other', 'app']
+  assert estimate_run_time(depmap, packages, durations, 1) == 270
+  assert estimate_run_time(depmap, packages, durations, 2) == 150
+
+def test_build_history():
+  data = {}
+  history = BuildHistory(data, keep=3)
+  for d in [10, 20, 30, 40]:
+    history.add('a', d)
+  assert data == {'a': [20, 30, 40]}
+  assert history.estimates(['a', 'b']) == {'a': 30, 'b': 30}
+
+def test_load_history_from_log(tmp_path):
+  log = tmp_path / 'build.log'
+  log.write_text('''\
+[2019-01-01 01:00:00] foo 1.0 [1.0-1] successful after 120s
+[2019-01-01 01:02:00] bar 2.0 [2.0-1] failed after 30s
+[2019-01-02 01:00:00] foo 1.1 [1.1-1] successful after 100s
+''')
+  assert load_history_from_log(log) == {'foo': [120, 100]}
+  assert load_history_from_log(tmp_path / 'missing') == {}
@@ -0,0 +1,149 @@
+import pathlib
+import sys
+import threading
+
+import pytest
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2.chroot import ChrootPool, Chroot, pacman_conf_with_repo
+from lilac2.localrepo import LocalRepo
+from lilaclib import call_build_cmd
+
+@pytest.fixture
+def stub_cmds(stub_command, tmp_path):
+  '''arch-nspawn and makechrootpkg that record their arguments'''
+  log = tmp_path / 'cmds.log'
+  for name in ['arch-nspawn', 'makechrootpkg']:
+    stub_command(name, f'#!/bin/sh\necho {name} "$@" >> {log}\n')
+
+  def read():
+    try:
+      return log.read_text().splitlines()
+    except FileNotFoundError:
+      return []
+  return read
+
+def make_pool(tmp_path, prefixes, pkgext=None):
+  basedir = tmp_path / 'archbuild'
+  for p in prefixes:
+    (basedir / p / 'root').mkdir(parents=True)
+  return ChrootPool(basedir, pkgext)
+
+def test_update_once_per_run(stub_cmds, tmp_path):
+  pool = make_pool(tmp_path, ['extra-x86_64', 'multilib'])
+  for i in range(3):
+    for prefix in ['extra-x86_64', 'multilib']:
+      with pool.lease(prefix) as chroot:
+        assert chroot == Chroot(pool.basedir / prefix, 'lilac-0', i == 0)
+
+  root = pool.basedir / 'extra-x86_64' / 'root'
+  assert stub_cmds().count(
+    f'arch-nspawn {root} pacman -Syuu --noconfirm') == 1
+  assert len(stub_cmds()) == 2
+
+def test_pkgext_in_makepkg_conf(stub_cmds, tmp_path):
+  pool = make_pool(tmp_path, ['extra-x86_64'], '.pkg.tar.zst')
+  for _ in range(2):
+    with pool.lease('extra-x86_64'):
+      pass
+
+  root = pool.basedir / 'extra-x86_64' / 'root'
+  cmds = stub_cmds()
+  assert cmds[0] == f'arch-nspawn {root} pacman -Syuu --noconfirm'
+  # the stub's echo turns the "\n" for printf into a line break
+  conf = '\n'.join(cmds[1:])
+  assert conf.startswith(f'arch-nspawn {root} sh -c sed -i ')
+  assert conf.count('arch-nspawn') == 1
+  assert 'PKGEXT=.pkg.tar.zst' in conf
+  assert 'COMPRESSZST=(zstd -c -T0 -)' in conf
+
+def test_concurrent_leases(stub_cmds, tmp_path):
+  pool = make_pool(tmp_path, ['extra-x86_64'])
+  leased = threading.Barrier(3)
+  copies = []
+
+  def build():
+    with pool.lease('extra-x86_64') as chroot:
+      copies.append(chroot.copy)
+      leased.wait()
+
+  threads = [threading.Thread(target=build) for _ in range(3)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert sorted(copies) == ['lilac-0', 'lilac-1', 'lilac-2']
+
+  with pool.lease('extra-x86_64') as chroot:
+    assert chroot.copy == 'lilac-0'
+    assert not chroot.clean
+
+def test_unmanaged(stub_cmds, tmp_path):
+  pool = make_pool(tmp_path, [])
+  with pool.lease('makepkg') as chroot:
+    assert chroot is None
+  with pool.lease('extra-x86_64') as chroot:
+    assert chroot is None
+  assert stub_cmds() == []
+
+def test_build_in_leased_chroot(stub_cmds, tmp_path):
+  pool = make_pool(tmp_path, ['extra-x86_64'])
+  with pool.lease('extra-x86_64') as chroot:
+    call_build_cmd('extra-x86_64', ['/tmp/dep.pkg.tar.zst'], chroot=chroot)
+
+  chrootdir = pool.basedir / 'extra-x86_64'
+  assert stub_cmds()[-1] == (
+    f'makechrootpkg -r {chrootdir} -l lilac-0 -c'
+    ' -I /tmp/dep.pkg.tar.zst -- --holdver')
+
+PACMAN_CONF = """\
+[options]
+Architecture = auto
+
+[core]
+Include = /etc/pacman.d/mirrorlist
+"""
+
+def test_pacman_conf_with_repo():
+  conf = pacman_conf_with_repo(PACMAN_CONF, 'local', pathlib.Path('/repo'))
+  lines = conf.splitlines()
+  i = lines.index('[local]')
+  assert lines[i+1:i+3] == ['SigLevel = Never', 'Server = file:///repo']
+  assert lines.index('[options]') < i < lines.index('[core]')
+  assert pacman_conf_with_repo(conf, 'local', pathlib.Path('/repo')) == conf
+
+  conf = pacman_conf_with_repo('[options]\n', 'local', pathlib.Path('/repo'))
+  assert conf.splitlines()[1:4] == [
+    '# lilac settings begin', '[local]', 'SigLevel = Never']
+
+def test_build_with_localrepo(stub_cmds, tmp_path):
+  localrepo = LocalRepo(tmp_path / 'local')
+  localrepo.reset()
+  basedir = tmp_path / 'archbuild'
+  root = basedir / 'extra-x86_64' / 'root'
+  (root / 'etc').mkdir(parents=True)
+  (root / 'etc' / 'pacman.conf').write_text(PACMAN_CONF)
+  pool = ChrootPool(basedir, localrepo=localrepo)
+
+  dep = localrepo.dir / 'dep.pkg.tar.zst'
+  with pool.lease('extra-x86_64') as chroot:
+    assert chroot.localrepo_db == localrepo.sync_db
+    call_build_cmd('extra-x86_64', [str(dep), '/tmp/other.pkg.tar.zst'],
+                   chroot=chroot)
+
+  cmds = stub_cmds()
+  assert cmds[0].startswith(f'arch-nspawn {root} sh -c ')
+  assert '[lilac-local]' in cmds
+  assert (f'arch-nspawn {root} --bind-ro={localrepo.dir}'
+          ' pacman -Syuu --noconfirm') in cmds
+  # only the root is updated from the mirrors
+  assert sum('pacman -Sy' in c for c in cmds) == 1
+  assert cmds[-1] == (
+    f'makechrootpkg -r {basedir / "extra-x86_64"} -l lilac-0 -c'
+    f' -D {localrepo.dir}'
+    f' -D {localrepo.sync_db}:/var/lib/pacman/sync/lilac-local.db'
+    f' -I {dep} -I /tmp/other.pkg.tar.zst -- --holdver')
@@ -0,0 +1,98 @@
+import pathlib
+import sys
+import time
+
+import pytest
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2.ghusers import GitHubUsers, RateLimited
+
+class FakeResponse:
+  def __init__(self, status_code, headers=None, json=None):
+    self.status_code = status_code
+    self.headers = headers or {}
+    self._json = json
+
+  def json(self):
+    return self._json
+
+  def raise_for_status(self):
+    if self.status_code >= 400:
+      raise Exception(f'HTTP {self.status_code}')
+
+class FakeGitHub:
+  '''answers from ``users`` and records the requests'''
+
+  def __init__(self, users):
+    self.users = users
+    self.requests = []
+    self.limited = False
+
+  def api_request(self, path, headers):
+    self.requests.append((path, dict(headers)))
+    if self.limited:
+      return FakeResponse(403, {
+        'X-RateLimit-Remaining': '0',
+        'X-RateLimit-Reset': str(time.time() + 600),
+      })
+    username = path.rsplit('/', 1)[-1]
+    name, email = self.users[username]
+    etag = f'"{name}-{email}"'
+    if headers.get('If-None-Match') == etag:
+      return FakeResponse(304)
+    return FakeResponse(
+      200, {'ETag': etag}, {'name': name, 'email': email})
+
+@pytest.fixture
+def gh():
+  return FakeGitHub({
+    'alice': ('Alice', 'alice@example.com'),
+    'bob': (None, 'bob@example.com'),
+  })
+
+def test_cached_within_ttl(gh, tmp_path):
+  file = tmp_path / 'users.json'
+  users = GitHubUsers(gh, file)
+  assert users.get('alice') == ('Alice', 'alice@example.com')
+  assert users.get('alice') == ('Alice', 'alice@example.com')
+  assert len(gh.requests) == 1
+
+  # and in the next run
+  users = GitHubUsers(gh, file)
+  assert users.get('alice') == ('Alice', 'alice@example.com')
+  assert len(gh.requests) == 1
+
+def test_revalidate_with_etag(gh, tmp_path):
+  users = GitHubUsers(gh, tmp_path / 'users.json', ttl=0)
+  users.get('alice')
+  assert users.get('alice') == ('Alice', 'alice@example.com')
+  assert gh.requests[1][1] == {'If-None-Match': '"Alice-alice@example.com"'}
+
+  gh.users['alice'] = ('Alice', 'new@example.com')
+  assert users.get('alice') == ('Alice', 'new@example.com')
+
+def test_rate_limited(gh, tmp_path):
+  users = GitHubUsers(gh, tmp_path / 'users.json', ttl=0)
+  users.get('alice')
+
+  gh.limited = True
+  # old entries are still usable
+  assert users.get('alice') == ('Alice', 'alice@example.com')
+  with pytest.raises(RateLimited):
+    users.get('bob')
+  # no more requests until the limit is reset
+  n = len(gh.requests)
+  with pytest.raises(RateLimited):
+    users.get('bob')
+  assert len(gh.requests) == n
+
+def test_prefetch(gh, tmp_path):
+  users = GitHubUsers(gh, tmp_path / 'users.json')
+  users.prefetch(['alice', 'bob', 'alice'])
+  assert sorted(p for p, _ in gh.requests) == ['/users/alice', '/users/bob']
+  assert users.get('bob') == (None, 'bob@example.com')
+  assert len(gh.requests) == 2
@@ -9,8 +9,9 @@ sys.path.insert(0, str(this_dir.parents[1]))
 sys.path.insert(0, str(this_dir.parents[1] / 'pylib'))
 
 from lilaclib import (
-  update_pkgrel,
+  update_pkgrel, obtain_array, get_pkgver_and_pkgrel,
 )
+from lilac2.api import obtain_variables
 
 from myutils import at_dir
 
@@ -30,3 +31,23 @@ def test_update_pkgrel(tmpdir, pkgbuild, expected_pkgbuild, kwargs):
     with open('PKGBUILD', 'r') as f:
       new_pkgbuild = f.read()
     assert new_pkgbuild == expected_pkgbuild
+
+def test_obtain_variables(tmpdir):
+  with at_dir(tmpdir):
+    with open('PKGBUILD', 'w') as f:
+      f.write('''\
+echo this should not get in the way
+_ver=1.2
+pkgver=$_ver.3
+pkgrel=2
+depends=('a' 'b c')
+makedepends=()
+''')
+    assert obtain_variables(['depends', 'makedepends', 'pkgver', 'unset']) == {
+      'depends': ['a', 'b c'],
+      'makedepends': None,
+      'pkgver': ['1.2.3'],
+      'unset': None,
+    }
+    assert obtain_array('depends') == ['a', 'b c']
+    assert get_pkgver_and_pkgrel() == ('1.2.3', 2)
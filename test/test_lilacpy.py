@@ -0,0 +1,40 @@
+import pathlib
+import sys
+
+import pytest
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2.lilacpy import _scan_lilac_py
+
+def scan(tmp_path, code):
+  f = tmp_path / 'lilac.py'
+  f.write_text(code)
+  return _scan_lilac_py(f)
+
+def test_scan_literals(tmp_path):
+  assert scan(tmp_path, '''\
+from lilaclib import *
+update_on = [{'source': 'aur'}]
+depends = ['foo']
+def pre_build():
+  depends = []
+''') == {'update_on': [{'source': 'aur'}], 'depends': ['foo']}
+
+@pytest.mark.parametrize('code', [
+  'update_on = [x for x in range(3)]',
+  'from common import *',
+  'from common import maintainers',
+  'update_on = []\nupdate_on.append({"source": "aur"})',
+  'maintainers = []\nmaintainers += [{"github": "x"}]',
+  'depends = ["a"]\ndepends[0] = "b"',
+  'depends = ["a"]\nextend(depends)',
+  'if True:\n  depends = ["a"]',
+  'depends = ["a"]\ndel depends',
+  'depends = ["a"]\ndel depends[0]',
+])
+def test_scan_not_static(tmp_path, code):
+  assert scan(tmp_path, code) is None
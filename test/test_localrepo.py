@@ -0,0 +1,38 @@
+import os
+import pathlib
+import sys
+import tarfile
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2.localrepo import LocalRepo
+
+def test_add(stub_command, tmp_path):
+  stub_command(
+    'repo-add', f'#!/bin/sh\necho "$@" >> {tmp_path}/repo-add.log\n')
+
+  pkgdir = tmp_path / 'foo'
+  pkgdir.mkdir()
+  f = pkgdir / 'foo-1.0-1-x86_64.pkg.tar.zst'
+  f.write_text('foo')
+
+  repo = LocalRepo(tmp_path / 'local')
+  repo.reset()
+  # pacman can sync it before anything is added
+  assert tarfile.open(repo.dir / 'lilac-local.db').getnames() == []
+  added = repo.add([f])
+  assert added == [repo.dir / f.name]
+  assert os.path.samefile(f, added[0])
+  assert (tmp_path / 'repo-add.log').read_text().split() == [
+    '--remove', '--quiet', str(repo.db), str(added[0])]
+
+  # still there after the package directory is cleaned up
+  f.unlink()
+  assert added[0].read_text() == 'foo'
+
+  repo.reset()
+  assert sorted(x.name for x in repo.dir.iterdir()) == [
+    'lilac-local.db', 'lilac-local.db.tar.gz']
@@ -0,0 +1,91 @@
+import io
+import os
+import pathlib
+import sys
+import time
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2 import logstore
+
+def make_log(lines):
+  return io.BytesIO(''.join(l + '\n' for l in lines).encode())
+
+def test_save_log(tmp_path):
+  lines = [
+    '==> Making package: foo 1.0-1',
+    'checking things',
+    '==> Starting build()...',
+    'cc -c foo.c',
+    'foo.c:1: error: oops',
+    '==> ERROR: A failure occurred in build().',
+  ]
+  path = logstore.save_log(make_log(lines), 'foo', '1.0/1', tmp_path)
+  assert path.parent == tmp_path / 'foo'
+  assert '1.0-1' in path.name
+
+  with logstore._open(path, 'rb') as f:
+    assert f.read() == make_log(lines).getvalue()
+
+  index = logstore.load_index(path)
+  offsets = [0]
+  for l in lines:
+    offsets.append(offsets[-1] + len(l) + 1)
+  assert index['size'] == offsets[-1]
+  assert index['phases'] == [[offsets[0], lines[0]], [offsets[2], lines[2]]]
+  assert index['errors'] == [offsets[4], offsets[5]]
+  assert index['error_count'] == 2
+
+def test_save_coloured_log(tmp_path):
+  lines = [
+    '\x1b[1m\x1b[32m==> \x1b[m\x1b[1mStarting build()...\x1b[m',
+    'cc -c foo.c',
+    '\x1b[1m\x1b[31m==> ERROR:\x1b[m\x1b[1m A failure occurred in build().\x1b[m',
+  ]
+  path = logstore.save_log(make_log(lines), 'foo', '1', tmp_path)
+  index = logstore.load_index(path)
+  assert index['phases'] == [[0, '==> Starting build()...']]
+  assert index['errors'] == [len(lines[0]) + len(lines[1]) + 2]
+
+def test_excerpt_without_errors(tmp_path):
+  lines = ['==> Starting build()...'] + [f'line {i}' for i in range(100)]
+  path = logstore.save_log(make_log(lines), 'foo', '1', tmp_path)
+  ex = logstore.excerpt(path, 200)
+  assert len(ex) <= 200
+  assert ex.startswith('……\n==> Starting build()...\n……\n')
+  assert ex.endswith('line 99\n')
+
+def test_excerpt_keeps_header_when_trimmed(tmp_path):
+  lines = (
+    ['==> Starting prepare()...']
+    + [f'prepare {i}' for i in range(100)]
+    + ['prepare.sh: error: first']
+    + ['==> Starting build()...']
+    + [f'build {i}' for i in range(100)]
+    + ['build.c: error: last']
+    + [f'after {i}' for i in range(100)]
+  )
+  path = logstore.save_log(make_log(lines), 'foo', '1', tmp_path)
+
+  ex = logstore.excerpt(path, 400)
+  assert len(ex) <= 400
+  # the first part is cut after its header, not in it
+  assert ex.startswith('……\n==> Starting prepare()...\n……\nprepare ')
+  assert 'error: first\n' in ex
+  assert '\n……\n==> Starting build()...\n……\nbuild ' in ex
+  assert 'error: last\n' in ex
+
+def test_prune(tmp_path):
+  old = logstore.save_log(make_log(['old']), 'foo', '1', tmp_path)
+  new = logstore.save_log(make_log(['new']), 'bar', '1', tmp_path)
+  t = time.time() - 31 * 86400
+  for p in [old, logstore._index_path(old)]:
+    os.utime(p, (t, t))
+
+  logstore.prune(30, tmp_path)
+  assert not (tmp_path / 'foo').exists()
+  assert new.exists()
+  assert logstore._index_path(new).exists()
@@ -0,0 +1,130 @@
+import pathlib
+import sys
+import json
+import email
+import threading
+import socketserver
+import configparser
+
+import pytest
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2.mail import MailService
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+  '''just enough SMTP for smtplib'''
+
+  def reply(self, line):
+    self.wfile.write(line.encode() + b'\r\n')
+
+  def handle(self):
+    self.server.connections += 1
+    self.reply('220 localhost')
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        return
+      cmd = line.decode().strip().split(' ', 1)[0].upper()
+      if cmd == 'DATA':
+        self.reply('354 go ahead')
+        data = []
+        while True:
+          l = self.rfile.readline()
+          if l == b'.\r\n':
+            break
+          data.append(l)
+        self.server.messages.append(
+          email.message_from_bytes(b''.join(data)))
+        self.reply('250 ok')
+      elif cmd == 'QUIT':
+        self.reply('221 bye')
+        return
+      else:
+        self.reply('250 ok')
+
+@pytest.fixture
+def smtp_server():
+  server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+  server.daemon_threads = True
+  server.connections = 0
+  server.messages = []
+  t = threading.Thread(target=server.serve_forever, daemon=True)
+  t.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+def make_service(server, spool, digest=False):
+  config = configparser.ConfigParser()
+  config.read_dict({
+    'lilac': {
+      'name': 'lilac',
+      'email': 'lilac@example.com',
+      'send_email': 'yes',
+    },
+    'smtp': {
+      'host': '127.0.0.1',
+      'port': str(server.server_address[1]),
+      'digest': 'yes' if digest else 'no',
+    },
+  })
+  return MailService(config, spool)
+
+def test_one_connection_for_all_mails(smtp_server, tmp_path):
+  ms = make_service(smtp_server, tmp_path)
+  for i in range(3):
+    ms.sendmail('a@example.com', f'subject {i}', f'body {i}')
+  ms.flush()
+
+  assert smtp_server.connections == 1
+  assert [m['Subject'] for m in smtp_server.messages] == [
+    '[lilac] subject 0', '[lilac] subject 1', '[lilac] subject 2']
+  assert list(tmp_path.iterdir()) == []
+
+def test_digest_per_recipient(smtp_server, tmp_path):
+  ms = make_service(smtp_server, tmp_path, digest=True)
+  ms.sendmail('a@example.com', 'first', 'body 1')
+  ms.sendmail('b@example.com', 'other', 'body 2')
+  ms.sendmail('a@example.com', 'second', 'body 3')
+  assert smtp_server.messages == []
+  ms.flush()
+
+  by_to = {m['To']: m for m in smtp_server.messages}
+  assert set(by_to) == {'a@example.com', 'b@example.com'}
+  body = by_to['a@example.com'].get_payload(decode=True).decode()
+  assert 'first' in body and 'second' in body
+  assert by_to['b@example.com']['Subject'] == '[lilac] other'
+  assert list(tmp_path.iterdir()) == []
+
+def test_recover_spool(smtp_server, tmp_path):
+  with open(tmp_path / '1-1-0.json', 'w') as f:
+    json.dump({'to': 'a@example.com', 'subject': 'left', 'msg': 'x'}, f)
+
+  ms = make_service(smtp_server, tmp_path)
+  ms.recover()
+  ms.flush()
+  assert [m['Subject'] for m in smtp_server.messages] == ['[lilac] left']
+  assert list(tmp_path.iterdir()) == []
+
+def test_sendmail_during_flush(smtp_server, tmp_path):
+  ms = make_service(smtp_server, tmp_path)
+
+  def send(n):
+    for i in range(10):
+      ms.sendmail('a@example.com', f'{n}-{i}', 'x')
+      ms.flush()
+
+  threads = [threading.Thread(target=send, args=(n,)) for n in range(4)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join(timeout=30)
+    assert not t.is_alive()
+  ms.flush()
+
+  assert len(smtp_server.messages) == 40
+  assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,28 @@
+import pathlib
+import sys
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2.packages import BuiltPackages, Dependency
+
+def test_resolve_in_own_pkgdir(tmp_path):
+  for pkgbase in ['foo', 'foo-git']:
+    (tmp_path / pkgbase).mkdir()
+    (tmp_path / pkgbase / 'foo-1.0-1-x86_64.pkg.tar.zst').touch()
+  built = BuiltPackages.scan(tmp_path)
+
+  for pkgbase in ['foo', 'foo-git']:
+    d = Dependency(tmp_path / pkgbase, 'foo', built)
+    assert d.resolve() == tmp_path / pkgbase / 'foo-1.0-1-x86_64.pkg.tar.zst'
+
+  # replacing files of one directory leaves the other alone
+  new = tmp_path / 'foo-2.0-1-x86_64.pkg.tar.zst'
+  new.touch()
+  built.replace_dir(tmp_path / 'foo-git', [new])
+  assert Dependency(tmp_path / 'foo-git', 'foo', built).resolve() == new
+  assert Dependency(tmp_path / 'foo', 'foo', built).resolve() \
+      == tmp_path / 'foo' / 'foo-1.0-1-x86_64.pkg.tar.zst'
+  assert Dependency(tmp_path / 'bar', 'foo', built).resolve() is None
@@ -0,0 +1,85 @@
+import os
+import pathlib
+import sys
+import subprocess
+
+import pytest
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2.publish import Publisher, package_files
+
+FAKE_GPG = '''\
+#!/bin/sh
+# a gpg that "signs" by writing the file name, and fails on "bad" files
+case "$*" in
+  *--detach-sign*)
+    for f; do :; done
+    case "$f" in bad-*) exit 2;; esac
+    echo "$f" > "$f.sig";;
+esac
+exit 0
+'''
+
+@pytest.fixture
+def fake_gpg(stub_command, tmp_path):
+  for name in ['gpg', 'gpgconf']:
+    stub_command(name, FAKE_GPG)
+  stub_command(
+    'repo-add', f'#!/bin/sh\necho "$@" >> {tmp_path}/repo-add.log\n')
+
+def make_pkgdir(tmp_path, names):
+  pkgdir = tmp_path / 'pkg'
+  pkgdir.mkdir()
+  for name in names:
+    (pkgdir / name).write_text(name)
+  return pkgdir
+
+def test_publish(fake_gpg, tmp_path):
+  names = [f'foo{i}-1.0-1-x86_64.pkg.tar.zst' for i in range(5)]
+  names.append('foo-old-1.0-1-any.pkg.tar.xz')
+  pkgdir = make_pkgdir(tmp_path, names + ['foo-1.0-1.src.tar.gz', 'PKGBUILD'])
+  destdir = tmp_path / 'dest'
+  destdir.mkdir()
+
+  publisher = Publisher(destdir, jobs=3)
+  files = package_files(pkgdir)
+  assert [f.name for f in files] == sorted(names)
+  publisher.submit(pkgdir, files).result()
+  publisher.shutdown()
+
+  expected = set(names) | {x + '.sig' for x in names} \
+      | {'foo-1.0-1.src.tar.gz'}
+  assert {f.name for f in destdir.iterdir()} == expected
+  for name in expected:
+    assert os.path.samefile(pkgdir / name, destdir / name)
+
+def test_publish_nothing_on_failure(fake_gpg, tmp_path):
+  names = ['foo-1.0-1-x86_64.pkg.tar.xz', 'bad-1.0-1-x86_64.pkg.tar.xz']
+  pkgdir = make_pkgdir(tmp_path, names)
+  destdir = tmp_path / 'dest'
+  destdir.mkdir()
+
+  publisher = Publisher(destdir)
+  fu = publisher.submit(pkgdir, package_files(pkgdir))
+  with pytest.raises(subprocess.CalledProcessError):
+    fu.result()
+  publisher.shutdown()
+  assert list(destdir.iterdir()) == []
+
+def test_update_db_with_new_files(fake_gpg, tmp_path):
+  names = ['foo-1.0-1-x86_64.pkg.tar.xz', 'foo-doc-1.0-1-any.pkg.tar.xz']
+  pkgdir = make_pkgdir(tmp_path, names)
+  destdir = tmp_path / 'dest'
+  destdir.mkdir()
+
+  publisher = Publisher(destdir, dbname='myrepo')
+  publisher.submit(pkgdir, package_files(pkgdir)).result()
+  publisher.shutdown()
+
+  args = (tmp_path / 'repo-add.log').read_text().split()
+  assert args == ['--remove', '--quiet', str(destdir / 'myrepo.db.tar.gz')] \
+      + [str(destdir / x) for x in names]
@@ -0,0 +1,65 @@
+import hashlib
+import os
+import pathlib
+import sys
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2 import srccache
+
+URL = 'https://example.com/foo-1.0.tar.gz'
+
+def make_srcinfo(sum):
+  return f'''\
+pkgbase = foo
+\tpkgver = 1.0
+\tsource = {URL}
+\tsource = bar.tar.gz::https://example.com/bar/1.0.tar.gz
+\tsource = git+https://example.com/baz.git
+\tsource = local.patch
+\tsha256sums = {sum}
+\tsha256sums = SKIP
+\tsha256sums = SKIP
+\tsha256sums = {sum}
+
+pkgname = foo
+'''.splitlines()
+
+def test_sources():
+  assert list(srccache._sources(make_srcinfo('abc'))) == [
+    ('foo-1.0.tar.gz', URL, 'sha256', 'abc'),
+  ]
+
+def test_sync(tmp_path):
+  cachedir = tmp_path / 'cache'
+  content = b'foo tarball'
+  srcinfo = make_srcinfo(hashlib.sha256(content).hexdigest())
+
+  a = tmp_path / 'a'
+  a.mkdir()
+  (a / 'foo-1.0.tar.gz').write_bytes(content)
+  srccache.sync(a, srcinfo, cachedir)
+  assert len(list(cachedir.iterdir())) == 1
+
+  b = tmp_path / 'b'
+  b.mkdir()
+  srccache.sync(b, srcinfo, cachedir)
+  assert (b / 'foo-1.0.tar.gz').read_bytes() == content
+
+def test_bad_checksum_not_cached(tmp_path):
+  cachedir = tmp_path / 'cache'
+  srcinfo = make_srcinfo(hashlib.sha256(b'expected').hexdigest())
+  (tmp_path / 'foo-1.0.tar.gz').write_bytes(b'something else')
+  srccache.sync(tmp_path, srcinfo, cachedir)
+  assert list(cachedir.iterdir()) == []
+
+def test_prune(tmp_path):
+  for i in range(4):
+    f = tmp_path / str(i)
+    f.write_bytes(b'x' * 100)
+    os.utime(f, (i, i))
+  srccache.prune(250, tmp_path)
+  assert sorted(f.name for f in tmp_path.iterdir()) == ['2', '3']
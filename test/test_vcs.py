@@ -0,0 +1,84 @@
+import pathlib
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+# sys.path does not support `Path`s yet
+this_dir = pathlib.Path(__file__).resolve()
+sys.path.insert(0, str(this_dir.parents[1]))
+sys.path.insert(0, str(this_dir.parents[1] / 'vendor'))
+
+from lilac2 import vcs
+
+def git(*args):
+  return subprocess.check_output(
+    ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com', *args],
+    universal_newlines=True).strip()
+
+def test_vcs_sources():
+  srcinfo = '''\
+pkgbase = foo
+\tsource = git+https://example.com/foo.git#branch=dev
+\tsource = bar::git+https://example.com/bar
+\tsource_x86_64 = git://example.com/baz.git
+\tsource = https://example.com/qux.tar.gz
+\tsource = hg+https://example.com/hg/quux#revision=1
+\tsource = svn+https://example.com/svn/trunk
+'''.splitlines()
+  assert list(vcs._vcs_sources(srcinfo)) == [
+    ('git', 'foo', 'https://example.com/foo.git'),
+    ('git', 'bar', 'https://example.com/bar'),
+    ('git', 'baz', 'git://example.com/baz.git'),
+    ('hg', 'quux', 'https://example.com/hg/quux'),
+  ]
+
+def test_mirror(tmp_path):
+  upstream = tmp_path / 'upstream'
+  git('init', '-q', str(upstream))
+  git('-C', str(upstream), 'commit', '-q', '--allow-empty', '-m', 'first')
+  url = upstream.as_uri()
+  srcinfo = ['pkgbase = foo', f'\tsource = foo::git+{url}']
+  vcsdir = tmp_path / 'vcs'
+  pkgdir = tmp_path / 'pkg'
+  pkgdir.mkdir()
+
+  vcs.use_mirrors(pkgdir, srcinfo, vcsdir)
+  assert len(list(vcsdir.iterdir())) == 1
+  assert git('-C', str(pkgdir / 'foo'), 'config', 'remote.origin.url') == url
+
+  git('-C', str(upstream), 'commit', '-q', '--allow-empty', '-m', 'second')
+  head = git('-C', str(upstream), 'rev-parse', 'HEAD')
+  vcs.update_mirrors(vcsdir=vcsdir)
+  vcs.use_mirrors(pkgdir, srcinfo, vcsdir)
+  assert git('-C', str(pkgdir / 'foo'), 'rev-parse', 'HEAD') == head
+
+def hg(*args):
+  return subprocess.check_output(
+    ['hg', '--config', 'ui.username=t', *args],
+    universal_newlines=True).strip()
+
+@pytest.mark.skipif(shutil.which('hg') is None, reason='needs hg')
+def test_hg_mirror(tmp_path):
+  upstream = tmp_path / 'upstream'
+  hg('init', str(upstream))
+  (upstream / 'a').write_text('a')
+  hg('-R', str(upstream), 'commit', '-q', '-A', '-m', 'first')
+  url = upstream.as_uri()
+  srcinfo = ['pkgbase = foo', f'\tsource = foo::hg+{url}']
+  vcsdir = tmp_path / 'vcs'
+  pkgdir = tmp_path / 'pkg'
+  pkgdir.mkdir()
+
+  vcs.use_mirrors(pkgdir, srcinfo, vcsdir)
+  assert len(list(vcsdir.iterdir())) == 1
+  assert hg('-R', str(pkgdir / 'foo'), 'paths', 'default') == url
+
+  (upstream / 'a').write_text('b')
+  hg('-R', str(upstream), 'commit', '-q', '-m', 'second')
+  tip = hg('-R', str(upstream), 'log', '-r', 'tip', '-T', '{node}')
+  vcs.update_mirrors(vcsdir=vcsdir)
+  vcs.use_mirrors(pkgdir, srcinfo, vcsdir)
+  assert hg('-R', str(pkgdir / 'foo'), 'log', '-r', 'tip', '-T', '{node}') \
+      == tip